@@ -0,0 +1,7 @@
+"""Benchmarks of gitlab-sync which run without a network or a real GitLab.
+
+A fake GitLab API serves listings of a synthetic tree of groups, subgroups and
+projects, and the repositories of those projects are local bare repositories
+cloned over file://. See `python -m benchmarks --help`.
+
+"""
@@ -0,0 +1,244 @@
+"""Run the benchmarks, and compare them with results from earlier commits."""
+import asyncio
+import datetime
+import json
+import logging
+import pathlib
+import subprocess
+import tempfile
+import time
+
+import attr
+import click
+import gitlab_sync.cache
+import gitlab_sync.repository
+import gitlab_sync.state
+import gitlab_sync.strategy
+from gitlab_sync.config import RunConfig
+
+from benchmarks.generate import generate_tree, make_local_copies, make_remotes
+from benchmarks.server import FakeGitLab
+
+
+def default_results():
+    return gitlab_sync.cache.default_directory().parent / "benchmarks.jsonl"
+
+
+def _commit():
+    """Return the commit of the working tree, and whether it has changes."""
+    directory = str(pathlib.Path(__file__).parent)
+
+    def git(*args):
+        return subprocess.run(
+            ["git", "-C", directory] + list(args),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+        ).stdout.strip()
+
+    return git("rev-parse", "--short", "HEAD") or None, bool(git("status", "-s"))
+
+
+async def _best_of(repeat, function):
+    """Return the fewest seconds an awaitable from function took to finish."""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await function()
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+
+async def _run(tree, directory, settings, repeat, mirror):
+    """Yield (case, seconds) for each benchmark of a tree."""
+    gitlab = FakeGitLab(tree, settings["per_page"], settings["latency"])
+    async with gitlab.serve() as server:
+        config = RunConfig(
+            base_path=directory / "copy",
+            paths=[pathlib.Path(path) for path in tree.paths],
+            access_token="token",
+            strategy=gitlab_sync.strategy.mirror,
+            gitlab_http=str(server.make_url("/")),
+            workers=settings["workers"],
+            http_cache=False,
+        )
+
+        async def enumerate_remote():
+            async for _ in gitlab_sync.repository.enumerate_remote(config):
+                pass
+
+        yield "enumerate_remote", await _best_of(repeat, enumerate_remote)
+
+        local = directory / "local"
+        make_local_copies(tree, local)
+
+        async def enumerate_local():
+            for _ in gitlab_sync.repository.enumerate_local(local):
+                pass
+
+        yield "enumerate_local", await _best_of(repeat, enumerate_local)
+        with gitlab_sync.state.StateIndex(local) as index:
+
+            async def enumerate_local_indexed():
+                for _ in gitlab_sync.repository.enumerate_local(local, index):
+                    pass
+
+            # fill the index, to then read from it
+            await enumerate_local_indexed()
+            yield "enumerate_local_indexed", await _best_of(
+                repeat, enumerate_local_indexed
+            )
+
+        if mirror:
+            config.base_path.mkdir()
+            config = attr.evolve(
+                config, gitlab_git=make_remotes(tree, directory / "remote")
+            )
+            yield "mirror", await _best_of(
+                1, lambda: gitlab_sync.strategy.mirror(config)
+            )
+            yield "mirror_unchanged", await _best_of(
+                repeat, lambda: gitlab_sync.strategy.mirror(config)
+            )
+
+
+def _compare(result, previous, threshold):
+    """Return a description of a result against the last from another commit."""
+    line = "%-24s %6d %9.3fs" % (
+        result["case"],
+        result["settings"]["repositories"],
+        result["seconds"],
+    )
+    for earlier in reversed(previous):
+        if (
+            earlier["case"] == result["case"]
+            and earlier["settings"] == result["settings"]
+            and earlier["commit"] != result["commit"]
+        ):
+            change = result["seconds"] / earlier["seconds"] - 1
+            line += "  (%.3fs at %s, %+.1f%%)" % (
+                earlier["seconds"],
+                earlier["commit"],
+                change * 100,
+            )
+            return line, change > threshold
+    return line, False
+
+
+@click.command()
+@click.option(
+    "-n",
+    "--repositories",
+    type=click.IntRange(min=1),
+    multiple=True,
+    default=[100, 1000, 10000],
+    show_default=True,
+    help="Number of projects in a tree, which can be given more than once.",
+)
+@click.option("--fanout", default=10, show_default=True, help="Subgroups per group.")
+@click.option("--group-size", default=50, show_default=True, help="Projects per group.")
+@click.option("--per-page", default=100, show_default=True, help="Most items per page.")
+@click.option(
+    "--latency",
+    default=0.0,
+    show_default=True,
+    help="Seconds the API takes to respond to each request.",
+)
+@click.option("--workers", default=8, show_default=True, help="Workers for mirror.")
+@click.option(
+    "--mirror-limit",
+    default=1000,
+    show_default=True,
+    help="Largest tree to run mirror on, as it clones every repository.",
+)
+@click.option(
+    "--repeat",
+    default=3,
+    show_default=True,
+    help="Times to run each benchmark, taking the fastest.",
+)
+@click.option(
+    "--results",
+    type=click.Path(dir_okay=False),
+    help="File results are kept in, to compare commits [default: %s]."
+    % default_results(),
+)
+@click.option(
+    "--threshold",
+    default=0.2,
+    show_default=True,
+    help="Fraction slower than the last commit to count as a regression.",
+)
+def main(
+    repositories,
+    fanout,
+    group_size,
+    per_page,
+    latency,
+    workers,
+    mirror_limit,
+    repeat,
+    results,
+    threshold,
+):
+    """Benchmark gitlab-sync against a fake GitLab with generated trees.
+
+    Each result is kept with the commit it was for, and compared with the last
+    result from a different commit with the same settings. Exits with status 1
+    if any are slower by more than the threshold.
+
+    """
+    logging.basicConfig(level=logging.ERROR)
+    results = pathlib.Path(results) if results else default_results()
+    previous = []
+    if results.exists():
+        with results.open() as file_:
+            previous = [json.loads(line) for line in file_ if line.strip()]
+    settings = dict(
+        fanout=fanout,
+        group_size=group_size,
+        per_page=per_page,
+        latency=latency,
+        workers=workers,
+    )
+    regressed = asyncio.get_event_loop().run_until_complete(
+        _main(
+            repositories, settings, mirror_limit, repeat, results, previous, threshold
+        )
+    )
+    if regressed:
+        raise SystemExit(1)
+
+
+async def _main(
+    repositories, settings, mirror_limit, repeat, results, previous, threshold
+):
+    """Run the benchmarks, returning True if any regressed."""
+    commit, dirty = _commit()
+    regressed = False
+    for count in repositories:
+        settings = dict(settings, repositories=count)
+        tree = generate_tree(count, settings["fanout"], settings["group_size"])
+        with tempfile.TemporaryDirectory(prefix="gitlab-sync-benchmark-") as directory:
+            async for case, seconds in _run(
+                tree, pathlib.Path(directory), settings, repeat, count <= mirror_limit
+            ):
+                result = {
+                    "case": case,
+                    "settings": settings,
+                    "seconds": seconds,
+                    "commit": commit,
+                    "dirty": dirty,
+                    "time": datetime.datetime.now().isoformat(),
+                }
+                line, slower = _compare(result, previous, threshold)
+                click.echo(line + ("  slower" if slower else ""))
+                regressed = regressed or slower
+                results.parent.mkdir(parents=True, exist_ok=True)
+                with results.open("a") as file_:
+                    file_.write(json.dumps(result) + "\n")
+    return regressed
+
+
+if __name__ == "__main__":
+    main()
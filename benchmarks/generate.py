@@ -0,0 +1,143 @@
+"""Generators of synthetic GitLab trees and the repositories to go with them."""
+import collections
+import os
+import pathlib
+import subprocess
+import tempfile
+import typing
+
+import attr
+
+# when every project was last active, which is long enough ago to be trusted
+LAST_ACTIVITY_AT = "2020-01-01T00:00:00.000Z"
+
+
+@attr.s(auto_attribs=True)
+class Group:
+    id: int
+    full_path: str
+    subgroups: typing.List["Group"] = attr.Factory(list)
+    projects: typing.List[dict] = attr.Factory(list)
+
+    def descendant_projects(self):
+        projects = list(self.projects)
+        for subgroup in self.subgroups:
+            projects.extend(subgroup.descendant_projects())
+        return sorted(projects, key=lambda project: project["id"])
+
+
+@attr.s(auto_attribs=True)
+class Tree:
+    """Groups by id and full path, and projects of users by username."""
+
+    groups: typing.Dict[str, Group]
+    users: typing.Dict[str, typing.List[dict]]
+    projects: typing.List[dict]
+
+    @property
+    def paths(self):
+        """Return the paths to configure to copy every project."""
+        return [
+            key
+            for key, group in self.groups.items()
+            if key == group.full_path and "/" not in key
+        ] + list(self.users)
+
+
+def generate_tree(
+    repositories, fanout=10, group_size=50, user_share=0.1, name="bench"
+) -> Tree:
+    """Return a tree with the given number of projects.
+
+    A share of the projects belong to a user, and the rest fill groups of
+    group_size projects, where each group has up to fanout subgroups, added
+    breadth first under a top level group.
+
+    """
+    projects = []
+
+    def project(namespace):
+        id_ = len(projects) + 1
+        projects.append(
+            {
+                "id": id_,
+                "path_with_namespace": "%s/project-%d" % (namespace, id_),
+                "last_activity_at": LAST_ACTIVITY_AT,
+                "default_branch": "main",
+            }
+        )
+        return projects[-1]
+
+    user = name + "-user"
+    users = {user: [project(user) for _ in range(int(repositories * user_share))]}
+    groups = collections.OrderedDict()
+    root = Group(1, name)
+    groups["1"] = groups[root.full_path] = root
+    unparented = collections.deque([root])
+    ordered = [root]
+    remaining = repositories - len(projects)
+    while len(ordered) * group_size < remaining:
+        parent = unparented[0]
+        id_ = len(ordered) + 1
+        group = Group(id_, "%s/group-%d" % (parent.full_path, id_))
+        parent.subgroups.append(group)
+        if len(parent.subgroups) == fanout:
+            unparented.popleft()
+        unparented.append(group)
+        ordered.append(group)
+        groups[str(id_)] = groups[group.full_path] = group
+    for group in ordered:
+        while len(group.projects) < group_size and len(projects) < repositories:
+            group.projects.append(project(group.full_path))
+    return Tree(groups, users, projects)
+
+
+def make_remotes(tree, directory):
+    """Make a bare repository for each project, and return the gitlab_git to use.
+
+    Every project is a symlink to one bare repository with a single commit,
+    so that trees of tens of thousands of projects are quick to make.
+
+    """
+    directory = pathlib.Path(directory)
+    template = directory / ".template.git"
+    with tempfile.TemporaryDirectory() as work_tree:
+        env = dict(
+            os.environ,
+            GIT_AUTHOR_NAME="benchmark",
+            GIT_AUTHOR_EMAIL="benchmark@example.com",
+            GIT_COMMITTER_NAME="benchmark",
+            GIT_COMMITTER_EMAIL="benchmark@example.com",
+        )
+        for args in (
+            ["init", "--quiet", "--initial-branch=main"],
+            ["commit", "--quiet", "--allow-empty", "--message=initial"],
+            ["clone", "--quiet", "--bare", ".", str(template)],
+        ):
+            subprocess.run(["git", "-C", work_tree] + args, env=env, check=True)
+    for project in tree.projects:
+        path = directory / (project["path_with_namespace"] + ".git")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.symlink_to(template)
+    return "file://%s/" % directory
+
+
+def make_local_copies(tree, base_path):
+    """Make what enumerate_local finds in copies of every project.
+
+    Only the git config gitlab-sync reads is written, as the repositories
+    aren't used for anything else.
+
+    """
+    base_path = pathlib.Path(base_path)
+    for project in tree.projects:
+        git_dir = base_path / project["path_with_namespace"] / ".git"
+        git_dir.mkdir(parents=True)
+        (git_dir / "config").write_text(
+            "[core]\n"
+            "\trepositoryformatversion = 0\n"
+            "\tbare = false\n"
+            "[gitlab-sync]\n"
+            "\tproject-id = %d\n"
+            "\tgitlab-path = %s\n" % (project["id"], project["path_with_namespace"])
+        )
@@ -0,0 +1,79 @@
+"""A stand-in for the GitLab API, serving the listings of a generated tree."""
+import asyncio
+
+from aiohttp import test_utils, web
+
+# GitLab leaves out X-Total-Pages for listings larger than this
+_COUNT_LIMIT = 10000
+
+
+class FakeGitLab(object):
+    """Serves listings of groups, subgroups and user projects from a Tree.
+
+    Pages hold at most per_page items, whatever the client asks for, and each
+    response is delayed by latency seconds.
+
+    """
+
+    def __init__(self, tree, per_page=100, latency=0.0):
+        self.tree = tree
+        self.per_page = per_page
+        self.latency = latency
+        self.requests = 0
+        # descendant projects of groups, as they are slow to gather
+        self._descendants = {}
+        self.app = web.Application()
+        self.app.router.add_get("/api/v4/groups/{group}/subgroups", self.subgroups)
+        self.app.router.add_get("/api/v4/groups/{group}/projects", self.group_projects)
+        self.app.router.add_get("/api/v4/users/{user}/projects", self.user_projects)
+
+    async def _respond(self, request, items):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if items is None:
+            return web.json_response({"message": "404 Not Found"}, status=404)
+        per_page = min(int(request.query.get("per_page", 20)), self.per_page)
+        if "id_after" in request.query:
+            id_after = int(request.query["id_after"])
+            items = [item for item in items if item["id"] > id_after]
+            return web.json_response(items[:per_page])
+        page = int(request.query.get("page", 1))
+        pages = max(1, -(-len(items) // per_page))
+        headers = {"X-Next-Page": str(page + 1) if page < pages else ""}
+        if len(items) <= _COUNT_LIMIT:
+            headers["X-Total-Pages"] = str(pages)
+        return web.json_response(
+            items[(page - 1) * per_page : page * per_page], headers=headers
+        )
+
+    async def subgroups(self, request):
+        group = self.tree.groups.get(request.match_info["group"])
+        items = None
+        if group is not None:
+            items = [
+                {"id": subgroup.id, "full_path": subgroup.full_path}
+                for subgroup in group.subgroups
+            ]
+        return await self._respond(request, items)
+
+    async def group_projects(self, request):
+        group = self.tree.groups.get(request.match_info["group"])
+        items = None
+        if group is not None:
+            if request.query.get("include_subgroups") == "true":
+                if group.id not in self._descendants:
+                    self._descendants[group.id] = group.descendant_projects()
+                items = self._descendants[group.id]
+            else:
+                items = group.projects
+        return await self._respond(request, items)
+
+    async def user_projects(self, request):
+        return await self._respond(
+            request, self.tree.users.get(request.match_info["user"])
+        )
+
+    def serve(self):
+        """Return a server to use with async with, with make_url for the API."""
+        return test_utils.TestServer(self.app)
@@ -1,7 +1,16 @@
 import logging
 
 logger = logging.getLogger("gitlab-sync")
+# whether to log the output of git commands, set by the cli
+tee_git = False
+# gitlab_sync.ssh.Multiplexer for git commands to share connections through,
+# set by the cli
+ssh_multiplexer = None
 
 
 class ConfigurationError(ValueError):
     """Raised for errors during loading config."""
+
+
+class SyncError(Exception):
+    """Raised when operations on some repositories failed during a run."""
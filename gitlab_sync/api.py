@@ -0,0 +1,246 @@
+"""Module for requests to the GitLab API.
+
+Requests go through an ApiSession, which retries them when GitLab fails or
+is busy, keeps under its rate limits, and counts requests and bytes for the
+metrics of a run.
+
+"""
+import asyncio
+import email.utils
+import random
+import time
+
+import aiohttp
+import gitlab_sync
+import gitlab_sync.metrics
+
+# responses worth trying a request again after
+_RETRY_STATUSES = {429, 500, 502, 503, 504}
+# seconds to wait before the first retry, which doubles each time up to a cap
+_BACKOFF = 0.5
+_BACKOFF_CAP = 30
+
+
+class ApiError(Exception):
+    """Raised for errors reported by the GitLab API."""
+
+
+async def error_message(response):
+    """Return a message describing an error response from GitLab."""
+    try:
+        data = await response.json(content_type=None)
+        message = data.get("message") or data.get("error") or data
+    except (ValueError, AttributeError, aiohttp.ClientError):
+        message = response.reason
+    return "{} {}: {} {}".format(
+        response.method, response.url, response.status, message
+    )
+
+
+class _AdaptiveLimit(object):
+    """Limits how many requests are made at once, adapting to the server.
+
+    The limit grows by one for every limit's worth of requests which succeed,
+    up to a maximum, and halves whenever the server pushes back.
+
+    """
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.limit = maximum
+        self.active = 0
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.active < int(self.limit))
+            self.active += 1
+
+    async def __aexit__(self, *exc_info):
+        async with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+    def increase(self):
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def decrease(self):
+        self.limit = max(1, self.limit / 2)
+
+
+class _RequestContext(object):
+    """Lets the response of a request be used with async with."""
+
+    def __init__(self, coroutine):
+        self._coroutine = coroutine
+        self._response = None
+
+    def __await__(self):
+        return self._coroutine.__await__()
+
+    async def __aenter__(self):
+        self._response = await self._coroutine
+        return self._response
+
+    async def __aexit__(self, *exc_info):
+        self._response.release()
+
+
+def _retry_after(headers):
+    """Return the seconds a Retry-After header says to wait, if it has one."""
+    value = headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(
+            0, email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        )
+    except (TypeError, ValueError):
+        return None
+
+
+class ApiSession(object):
+    """Session for requests to the GitLab API which copes with a busy server.
+
+    Requests which time out, fail to connect, or get a response saying to try
+    again later are retried with jittered exponential backoff, waiting as long
+    as Retry-After says to if given. Requests stop being made while the
+    RateLimit-* headers say the limit is close, and the number of requests
+    made at once is adapted to how the server is coping.
+
+    """
+
+    def __init__(self, config):
+        self.config = config
+        trace = aiohttp.TraceConfig()
+        trace.on_request_end.append(_count_request)
+        trace.on_request_chunk_sent.append(_count_sent)
+        trace.on_response_chunk_received.append(_count_received)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=config.api_connections,
+                limit_per_host=config.api_connections,
+                # aiohttp only stops keeping connections alive with force_close
+                keepalive_timeout=config.api_keepalive or None,
+                force_close=not config.api_keepalive,
+                use_dns_cache=bool(config.api_dns_cache),
+                ttl_dns_cache=config.api_dns_cache or None,
+            ),
+            headers={"Private-Token": config.access_token},
+            trace_configs=[trace],
+            timeout=aiohttp.ClientTimeout(
+                total=None,
+                sock_connect=config.api_timeout,
+                sock_read=config.api_timeout,
+            ),
+        )
+        self.limit = _AdaptiveLimit(config.api_concurrency)
+        self._resume_at = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    def get(self, url, **kwargs):
+        return _RequestContext(self.request("GET", url, **kwargs))
+
+    def post(self, url, **kwargs):
+        return _RequestContext(self.request("POST", url, **kwargs))
+
+    async def request(self, method, url, **kwargs):
+        """Return the response to a request, retrying it if needs be.
+
+        The response has to be released, or used with async with.
+
+        """
+        attempt = 0
+        while True:
+            delay = self._resume_at - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            retry_after = None
+            async with self.limit:
+                try:
+                    with gitlab_sync.metrics.timed(
+                        "http", method, url=str(url), attempt=attempt
+                    ):
+                        response = await self.session.request(method, url, **kwargs)
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    if attempt >= self.config.api_retries:
+                        raise
+                    reason = str(e) or type(e).__name__
+                else:
+                    self._check_rate_limit(response.headers)
+                    if (
+                        response.status not in _RETRY_STATUSES
+                        or attempt >= self.config.api_retries
+                    ):
+                        self.limit.increase()
+                        return response
+                    response.release()
+                    reason = response.status
+                    retry_after = _retry_after(response.headers)
+                    if response.status in (429, 503):
+                        self.limit.decrease()
+            if retry_after is None:
+                retry_after = random.uniform(
+                    0, min(_BACKOFF_CAP, _BACKOFF * 2**attempt)
+                )
+            gitlab_sync.logger.warning(
+                "retrying %s %s in %.1fs after %s", method, url, retry_after, reason
+            )
+            gitlab_sync.metrics.count("http_retries")
+            await asyncio.sleep(retry_after)
+            attempt += 1
+
+    def _check_rate_limit(self, headers):
+        """Stop making requests until the rate limit resets if it is close."""
+        try:
+            remaining = int(headers["RateLimit-Remaining"])
+            reset = float(headers["RateLimit-Reset"])
+        except (KeyError, ValueError):
+            return
+        if remaining <= self.limit.maximum and reset > self._resume_at:
+            gitlab_sync.logger.info(
+                "waiting for the GitLab rate limit to reset, %d requests left",
+                remaining,
+            )
+            self.limit.decrease()
+            self._resume_at = reset
+
+
+async def _count_request(session, context, params):
+    gitlab_sync.metrics.count("http_requests")
+
+
+async def _count_sent(session, context, params):
+    gitlab_sync.metrics.count("http_sent_bytes", len(params.chunk))
+
+
+async def _count_received(session, context, params):
+    gitlab_sync.metrics.count("http_received_bytes", len(params.chunk))
+
+
+def api_session(config):
+    """Return a session for requests to the GitLab API."""
+    return ApiSession(config)
+
+
+async def graphql(session, config, query, **variables):
+    """Return the data from a query to the GitLab GraphQL API."""
+    async with session.post(
+        "{}api/graphql".format(config.gitlab_http),
+        json={"query": query, "variables": variables},
+    ) as response:
+        if response.status >= 400:
+            raise ApiError(await error_message(response))
+        result = await response.json()
+    if result.get("errors"):
+        raise ApiError("; ".join(error["message"] for error in result["errors"]))
+    return result["data"]
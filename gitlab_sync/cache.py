@@ -0,0 +1,101 @@
+"""Module for caching responses from the GitLab API on disk.
+
+Cached responses are only used after GitLab confirms they are still current,
+by responding to a request with If-None-Match set to the cached ETag with a
+304 rather than the whole response.
+
+"""
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+import typing
+
+import attr
+from gitlab_sync import logger
+
+# headers needed to use a cached response in place of a real one
+_HEADERS = ("X-Total-Pages", "X-Next-Page")
+
+
+def default_directory() -> pathlib.Path:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or pathlib.Path.home() / ".cache"
+    return pathlib.Path(cache_home) / "gitlab-sync" / "http"
+
+
+@attr.s(auto_attribs=True)
+class CachedResponse:
+    etag: str
+    headers: typing.Dict[str, str]
+    data: typing.Any
+
+
+class HttpCache(object):
+    """Cache of API responses keyed by URL, parameters, and access token.
+
+    The least recently used responses are evicted by evict once the cache is
+    larger than max_size bytes.
+
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+    def key(self, url, params, access_token):
+        token_hash = hashlib.sha256(access_token.encode()).hexdigest()
+        request = json.dumps(
+            [url, sorted((str(k), str(v)) for k, v in params.items()), token_hash]
+        )
+        return hashlib.sha256(request.encode()).hexdigest()
+
+    def _path(self, key):
+        return self.directory / key[:2] / (key + ".json")
+
+    def get(self, key) -> typing.Optional[CachedResponse]:
+        path = self._path(key)
+        try:
+            with path.open() as file_:
+                response = CachedResponse(**json.load(file_))
+        except (OSError, ValueError, TypeError):
+            return None
+        # mark as recently used
+        os.utime(str(path))
+        return response
+
+    def put(self, key, etag, headers, data):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        response = CachedResponse(
+            etag, {name: headers[name] for name in _HEADERS if name in headers}, data
+        )
+        # write then rename, so readers never see part of a response
+        fd, temp_path = tempfile.mkstemp(dir=str(path.parent), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as file_:
+                json.dump(attr.asdict(response), file_)
+            os.replace(temp_path, str(path))
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def evict(self):
+        """Remove the least recently used responses until under max_size."""
+        files = []
+        for path in self.directory.glob("*/*.json"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        size = sum(file_size for _, file_size, _ in files)
+        for _, file_size, path in sorted(files):
+            if size <= self.max_size:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            size -= file_size
+            logger.debug("evicted %s from the HTTP cache", path.name)
@@ -1,17 +1,37 @@
 #!/usr/bin/env python
+import asyncio
+import contextlib
+import cProfile
 import logging
+import signal
 
+import attr
 import click
 import gitlab_sync
+import gitlab_sync.daemon
+import gitlab_sync.metrics
+import gitlab_sync.repository
+import gitlab_sync.ssh
 import gitlab_sync.strategy
 from gitlab_sync.config import find_and_load_config
-from gitlab_sync import ConfigurationError, logger
+from gitlab_sync import ConfigurationError, SyncError, logger
 
 
 @click.group()
 @click.option("-v", "--verbose", count=True)
+@click.option(
+    "--profile",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Write a timeline of the run to this file, to open in Perfetto or"
+    " chrome://tracing.",
+)
+@click.option(
+    "--profile-stats",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Profile the run with cProfile, and write the stats to this file.",
+)
 @click.pass_context
-def main(ctx, verbose):
+def main(ctx, verbose, profile, profile_stats):
     log_level = [logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG][
         min(verbose, 3)
     ]
@@ -30,10 +50,46 @@ def main(ctx, verbose):
 
     ctx.obj = config
 
+    if profile:
+        gitlab_sync.metrics.recorder.start_trace()
+        ctx.call_on_close(lambda: gitlab_sync.metrics.recorder.write_trace(profile))
+    if profile_stats:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+        def write_stats():
+            profiler.disable()
+            profiler.dump_stats(profile_stats)
+
+        ctx.call_on_close(write_stats)
+
 
 @main.command("local-update", short_help="synchronise managed repositories")
+@click.option(
+    "-j",
+    "--workers",
+    type=click.IntRange(min=1),
+    help="Number of repositories to clone/update at once, overriding config.",
+)
+@click.option(
+    "--full",
+    is_flag=True,
+    help="List and update every repository, even in copies configured as"
+    " incremental or with delta-listing, or whose refs haven't changed.",
+)
+@click.option(
+    "--report",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Write timings and counts from the run to this file as JSON.",
+)
+@click.option(
+    "--prometheus",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Write timings and counts from the run to this file for the node"
+    " exporter textfile collector.",
+)
 @click.pass_context
-def local_update(ctx):
+def local_update(ctx, workers, full, report, prometheus):
     """Manage local copies of repositories on GitLab."""
     run_configs = ctx.obj
     # XXX: more like mirror really, and that should be a config only thing,
@@ -41,8 +97,130 @@ def local_update(ctx):
     # XXX: could return projectless repos (new) and missing repos? maybe
     # guard against deleting all projects if restoring config from backup
     # but not repo directory
+    configs = []
     for config in run_configs.values():
-        config.strategy(config)
+        if workers:
+            config = attr.evolve(config, workers=workers)
+        if full:
+            config = attr.evolve(
+                config, incremental=False, delta_listing=False, ref_check="none"
+            )
+        configs.append(config)
+    loop = asyncio.get_event_loop()
+    succeeded = False
+    try:
+        succeeded = loop.run_until_complete(_synchronise(configs))
+    finally:
+        if report:
+            gitlab_sync.metrics.recorder.write_json(report, succeeded)
+        if prometheus:
+            gitlab_sync.metrics.recorder.write_prometheus(prometheus, succeeded)
+    if not succeeded:
+        raise SystemExit(1)
+
+
+@main.command("serve", short_help="synchronise repositories as GitLab changes")
+@click.option(
+    "--host",
+    default="127.0.0.1",
+    show_default=True,
+    help="Address to listen for GitLab hooks on.",
+)
+@click.option(
+    "--port", default=8080, show_default=True, help="Port to listen for hooks on."
+)
+@click.option(
+    "--hook-token",
+    envvar="GITLAB_SYNC_HOOK_TOKEN",
+    help="Secret token of the hooks in GitLab, or GITLAB_SYNC_HOOK_TOKEN.",
+)
+@click.option(
+    "--reconcile-interval",
+    type=click.IntRange(min=1),
+    default=60 * 60,
+    show_default=True,
+    help="Seconds between full runs of every local copy.",
+)
+@click.pass_context
+def serve(ctx, host, port, hook_token, reconcile_interval):
+    """Synchronise projects when GitLab hooks say they have changed."""
+    configs = list(ctx.obj.values())
+    if hook_token is None:
+        logger.warning("accepting hooks without a secret token")
+    daemon = gitlab_sync.daemon.Daemon(configs, hook_token, reconcile_interval)
+    loop = asyncio.get_event_loop()
+    with _sharing_ssh(configs):
+        task = asyncio.ensure_future(daemon.run(host, port))
+        # clean up on the way out, rather than leaving SSH masters running
+        for signal_ in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signal_, task.cancel)
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+
+
+@contextlib.contextmanager
+def _sharing_ssh(configs):
+    """Share SSH connections between git commands of copies using SSH."""
+    configs = [
+        config for config in configs if gitlab_sync.ssh.uses_ssh(config.gitlab_git)
+    ]
+    masters = max([config.ssh_masters for config in configs] or [0])
+    if not masters:
+        yield
+        return
+    sessions = min(config.ssh_sessions for config in configs)
+    with gitlab_sync.ssh.Multiplexer(masters, sessions) as gitlab_sync.ssh_multiplexer:
+        try:
+            yield
+        finally:
+            gitlab_sync.ssh_multiplexer = None
+
+
+async def _synchronise(configs):
+    """Synchronise local copies concurrently, returning False if any failed.
+
+    Copies using the same GitLab and access token share one enumeration.
+
+    """
+    with _sharing_ssh(configs):
+        return await _synchronise_copies(configs)
+
+
+async def _synchronise_copies(configs):
+    enumerations = gitlab_sync.repository.share_enumerations(
+        configs,
+        {
+            config.base_path: gitlab_sync.strategy.delta_since(config)
+            for config in configs
+        },
+    )
+    copies = [
+        (
+            config,
+            config.strategy(
+                config, enumeration.remotes(config), since=enumeration.since
+            ),
+        )
+        for enumeration in enumerations
+        for config in enumeration.configs
+    ]
+    results = await asyncio.gather(
+        *[strategy for _, strategy in copies],
+        *[enumeration.run() for enumeration in enumerations],
+        return_exceptions=True
+    )
+    succeeded = True
+    for (config, _), result in zip(copies, results):
+        if isinstance(result, SyncError):
+            logger.error(str(result))
+        elif isinstance(result, Exception):
+            logger.error("%s: %s", config.base_path, result, exc_info=result)
+        else:
+            continue
+        succeeded = False
+    return succeeded
 
 
 if __name__ == "__main__":
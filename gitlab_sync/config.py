@@ -7,7 +7,6 @@ other members should be considered private.
 import os
 import subprocess
 import sys
-import types
 import typing
 from pathlib import Path
 
@@ -21,8 +20,10 @@ from voluptuous import (
     Any,
     Boolean,
     Invalid,
+    Match,
     MultipleInvalid,
     Optional,
+    Range,
     Replace,
     Required,
     Schema,
@@ -58,12 +59,11 @@ def string_or_source(value: typing.Union[str, typing.List[str]]) -> str:
     ).stdout.strip()
 
 
-def valid_strategy(value: str) -> typing.Callable[["RunConfig"], None]:
+def valid_strategy(value: str) -> typing.Callable[["RunConfig"], typing.Awaitable]:
     """Lookup a strategy given it's name."""
-    strategy = getattr(gitlab_sync.strategy, value, None)
-    if not isinstance(strategy, types.FunctionType):
+    if value not in gitlab_sync.strategy.STRATEGIES:
         raise Invalid("Must be the name of a strategy.")
-    return strategy
+    return getattr(gitlab_sync.strategy, value)
 
 
 def strip_path_single_path(copy_config):
@@ -72,6 +72,14 @@ def strip_path_single_path(copy_config):
     return copy_config
 
 
+def complete_history_for_pool(copy_config):
+    if copy_config.get("object_pool") and (
+        copy_config.get("depth") or copy_config.get("filter")
+    ):
+        raise Invalid("object-pool can't be used with depth or filter")
+    return copy_config
+
+
 schema = Schema(
     {
         Required(absolute_dir_path): All(
@@ -84,8 +92,62 @@ schema = Schema(
                 Optional(All("gitlab-http", Replace("-", "_"))): Url(),
                 Optional(All("gitlab-git", Replace("-", "_"))): Url(),
                 Optional(All("strip-path", Replace("-", "_"))): Boolean,
+                Optional("workers"): All(int, Range(min=1)),
+                Optional("incremental"): Boolean,
+                Optional(All("http-cache", Replace("-", "_"))): Boolean,
+                Optional(All("http-cache-size", Replace("-", "_"))): All(
+                    int, Range(min=0)
+                ),
+                Optional(All("object-pool", Replace("-", "_"))): absolute_dir_path,
+                Optional(All("maintenance-budget", Replace("-", "_"))): All(
+                    Any(int, float), Range(min=0)
+                ),
+                Optional(All("repack-interval", Replace("-", "_"))): All(
+                    Any(int, float), Range(min=0)
+                ),
+                Optional(All("single-branch", Replace("-", "_"))): Boolean,
+                Optional("depth"): All(int, Range(min=1)),
+                Optional("filter"): Match(
+                    r"^(blob:none|blob:limit=\d+[kmg]?|tree:\d+)$"
+                ),
+                Optional(All("sparse-checkout", Replace("-", "_"))): [str],
+                Optional(All("api-timeout", Replace("-", "_"))): All(
+                    Any(int, float), Range(min=0, min_included=False)
+                ),
+                Optional(All("api-retries", Replace("-", "_"))): All(int, Range(min=0)),
+                Optional(All("api-concurrency", Replace("-", "_"))): All(
+                    int, Range(min=1)
+                ),
+                Optional(All("api-connections", Replace("-", "_"))): All(
+                    int, Range(min=1)
+                ),
+                Optional(All("api-keepalive", Replace("-", "_"))): All(
+                    Any(int, float), Range(min=0)
+                ),
+                Optional(All("api-dns-cache", Replace("-", "_"))): All(
+                    Any(int, float), Range(min=0)
+                ),
+                Optional(All("ssh-masters", Replace("-", "_"))): All(int, Range(min=0)),
+                Optional(All("ssh-sessions", Replace("-", "_"))): All(
+                    int, Range(min=1)
+                ),
+                Optional(All("namespace-workers", Replace("-", "_"))): All(
+                    int, Range(min=0)
+                ),
+                Optional(All("project-statistics", Replace("-", "_"))): Boolean,
+                Optional(All("delta-listing", Replace("-", "_"))): Boolean,
+                Optional(All("full-listing-interval", Replace("-", "_"))): All(
+                    Any(int, float), Range(min=0)
+                ),
+                Optional(All("ref-check", Replace("-", "_"))): Any(
+                    "auto", "ls-remote", "api", "none"
+                ),
+                Optional("enumeration"): Any(
+                    "auto", "include-subgroups", "graphql", "traverse"
+                ),
             },
             strip_path_single_path,
+            complete_history_for_pool,
         )
     }
 )
@@ -125,10 +187,47 @@ class RunConfig:
     base_path: Path
     paths: typing.List[Path]
     access_token: str
-    strategy: typing.Callable[["RunConfig"], None]
+    strategy: typing.Callable[["RunConfig"], typing.Awaitable]
     gitlab_http: str = "https://gitlab.com/"
     gitlab_git: str = "ssh://git@gitlab.com/"
     strip_path: bool = False
+    workers: int = 1
+    incremental: bool = False
+    enumeration: str = "auto"
+    http_cache: bool = True
+    # in MiB
+    http_cache_size: int = 64
+    object_pool: typing.Optional[Path] = None
+    # seconds to spend on maintenance per run, and days between full repacks
+    maintenance_budget: float = 300
+    repack_interval: float = 30
+    single_branch: bool = False
+    ref_check: str = "auto"
+    # seconds to wait on GitLab, retries of failed requests, and the most
+    # requests to make at once
+    api_timeout: float = 60
+    api_retries: int = 5
+    api_concurrency: int = 16
+    # connections to keep open to GitLab, seconds to keep idle ones, and
+    # seconds to cache DNS lookups, 0 turning off either
+    api_connections: int = 16
+    api_keepalive: float = 15
+    api_dns_cache: float = 10
+    # SSH master connections to share between git commands, 0 for none, and
+    # how many commands each can carry at once (sshd's MaxSessions)
+    ssh_masters: int = 2
+    ssh_sessions: int = 10
+    # the most workers projects in one namespace can have at once, 0 for no
+    # limit, and whether to get repository sizes to start the largest first
+    namespace_workers: int = 0
+    project_statistics: bool = False
+    # only list projects active since the last run, with every project
+    # listed at least every full_listing_interval hours
+    delta_listing: bool = False
+    full_listing_interval: float = 24
+    depth: typing.Optional[int] = None
+    filter: typing.Optional[str] = None
+    sparse_checkout: typing.List[str] = attr.Factory(list)
 
 
 def find_and_load_config() -> typing.List[RunConfig]:
@@ -0,0 +1,194 @@
+"""Module for keeping local copies up to date from GitLab hooks.
+
+GitLab system hooks and project webhooks say which projects have changed, so
+only those projects need synchronising, moments after they change. Hooks can
+be missed while the daemon isn't running, or if GitLab fails to send them, so
+each local copy also has a full run of its strategy now and then.
+
+"""
+import asyncio
+import hmac
+import pathlib
+import typing
+
+import attr
+from aiohttp import web
+import gitlab_sync.repository
+import gitlab_sync.strategy
+from gitlab_sync import SyncError, logger
+
+# events for a single project, with project_id set
+_PROJECT_EVENTS = {
+    "push",
+    "tag_push",
+    "repository_update",
+    "project_create",
+    "project_destroy",
+    "project_rename",
+    "project_transfer",
+    "project_update",
+}
+# events which can affect every project in a group or user namespace
+_NAMESPACE_EVENTS = {"group_destroy", "group_rename", "user_rename", "user_destroy"}
+# keys of events which hold the paths affected
+_PATH_KEYS = (
+    "path_with_namespace",
+    "old_path_with_namespace",
+    "full_path",
+    "old_full_path",
+    "username",
+    "old_username",
+)
+
+
+@attr.s(auto_attribs=True)
+class HookEvent:
+    """The project (if just the one) and paths on GitLab affected by an event."""
+
+    project_id: typing.Optional[int]
+    paths: typing.List[pathlib.Path] = attr.Factory(list)
+
+
+def parse_event(event) -> typing.Optional[HookEvent]:
+    """Return what a system hook or webhook event affects, or None if nothing."""
+    name = event.get("event_name") or event.get("object_kind")
+    values = dict(event)
+    values.update(
+        (key, value)
+        for key, value in (event.get("project") or {}).items()
+        if key in _PATH_KEYS
+    )
+    paths = [pathlib.Path(values[key]) for key in _PATH_KEYS if values.get(key)]
+    if name in _PROJECT_EVENTS:
+        project_id = event.get("project_id") or (event.get("project") or {}).get("id")
+        if project_id is not None:
+            return HookEvent(int(project_id), paths)
+    if name in _NAMESPACE_EVENTS:
+        return HookEvent(None, paths)
+    return None
+
+
+class CopyWorker(object):
+    """Coalesces work for a local copy, and does it one batch at a time.
+
+    Projects to synchronise are collected while a batch runs, so however many
+    events there are for a project, it is only synchronised once per batch.
+    A full run of the strategy takes the place of any projects waiting.
+
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._projects = set()
+        self._reconcile = False
+        self._wakeup = asyncio.Event()
+
+    def notify(self, event, instance=None):
+        """Queue whatever work an event for the given GitLab instance needs."""
+        if instance and instance.rstrip("/") != self.config.gitlab_http.rstrip("/"):
+            return
+        if event.paths and not any(
+            gitlab_sync.repository.overlaps(path, self.config.paths)
+            for path in event.paths
+        ):
+            return
+        if (
+            event.project_id is None
+            or self.config.strategy is not gitlab_sync.strategy.mirror
+        ):
+            self.reconcile()
+        else:
+            self.sync(event.project_id)
+
+    def sync(self, project_id):
+        self._projects.add(project_id)
+        self._wakeup.set()
+
+    def reconcile(self):
+        self._reconcile = True
+        self._wakeup.set()
+
+    async def run(self, reconcile_interval):
+        """Do work as it is queued, with a full run every reconcile_interval seconds."""
+        periodic = asyncio.ensure_future(self._reconcile_every(reconcile_interval))
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self._reconcile or self._projects:
+                    await self._work()
+        finally:
+            periodic.cancel()
+
+    async def _reconcile_every(self, interval):
+        while True:
+            self.reconcile()
+            await asyncio.sleep(interval)
+
+    async def _work(self):
+        if self._reconcile:
+            self._reconcile = False
+            # a full run synchronises the projects waiting too
+            self._projects.clear()
+            logger.info("%s: synchronising every project", self.config.base_path)
+            work = self.config.strategy(self.config)
+        else:
+            project_ids = sorted(self._projects)
+            self._projects.clear()
+            work = gitlab_sync.strategy.sync_projects(self.config, project_ids)
+        try:
+            if await work:
+                self.reconcile()
+        except SyncError as e:
+            logger.error(str(e))
+        except Exception as e:
+            logger.error("%s: %s", self.config.base_path, e, exc_info=e)
+
+
+class Daemon(object):
+    """Takes events from GitLab over HTTP, and passes them on to CopyWorkers.
+
+    If a hook token is given, requests must have it as their X-Gitlab-Token,
+    which is the secret token set for the hook in GitLab.
+
+    """
+
+    def __init__(self, configs, hook_token=None, reconcile_interval=60 * 60):
+        self.copies = [CopyWorker(config) for config in configs]
+        self.hook_token = hook_token
+        self.reconcile_interval = reconcile_interval
+        self.app = web.Application()
+        self.app.router.add_post("/", self.handle)
+
+    async def handle(self, request):
+        if self.hook_token is not None and not hmac.compare_digest(
+            request.headers.get("X-Gitlab-Token", "").encode(),
+            self.hook_token.encode(),
+        ):
+            return web.json_response({"message": "401 Unauthorized"}, status=401)
+        try:
+            event = await request.json()
+        except ValueError:
+            event = None
+        if not isinstance(event, dict):
+            return web.json_response({"message": "400 Bad Request"}, status=400)
+        hook = parse_event(event)
+        if hook is None:
+            return web.json_response({"message": "ignored"})
+        logger.debug("received %s", hook)
+        for copy in self.copies:
+            copy.notify(hook, request.headers.get("X-Gitlab-Instance"))
+        return web.json_response({"message": "queued"})
+
+    async def run(self, host, port):
+        """Serve hooks and do the work they need until cancelled."""
+        runner = web.AppRunner(self.app)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, host, port).start()
+            logger.info("listening for GitLab hooks on %s:%d", host, port)
+            await asyncio.gather(
+                *[copy.run(self.reconcile_interval) for copy in self.copies]
+            )
+        finally:
+            await runner.cleanup()
@@ -0,0 +1,253 @@
+"""Module for measuring where the time of a run goes.
+
+Phases of each strategy, operations on each repository, and git commands are
+timed, and requests to GitLab counted, so that a report of a run can be
+written for dashboards. Timings are wall clock time, so operations running
+at once add up to more than the length of the phase they run in.
+
+When tracing, each timing is also kept as an event in the Trace Event Format,
+which Perfetto and chrome://tracing show as a timeline of the run.
+
+"""
+import asyncio
+import collections
+import contextlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+import attr
+
+
+@attr.s(auto_attribs=True)
+class Timing:
+    count: int = 0
+    failed: int = 0
+    seconds: float = 0.0
+
+
+class Metrics(object):
+    """Timings keyed by (kind, name, copy), and counters keyed by name."""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self._started = time.monotonic()
+        self.timings = collections.defaultdict(Timing)
+        self.counters = collections.Counter()
+        # trace events, if tracing
+        self.trace = None
+        self._lanes = {}
+
+    def start_trace(self):
+        self.trace = []
+
+    @contextlib.contextmanager
+    def timed(self, kind, name, copy=None, **details):
+        """Time the body of a with statement, counting it as failed if it raises.
+
+        Details are only kept in the trace, as arguments of its event. A dict
+        with the name is given to the body, which can change it for things
+        whose outcome is only known once they finish.
+
+        """
+        copy = None if copy is None else str(copy)
+        timed = {"name": name}
+        failed = False
+        started = time.monotonic()
+        try:
+            yield timed
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            finished = time.monotonic()
+            name = timed["name"]
+            timing = self.timings[kind, name, copy]
+            timing.count += 1
+            timing.failed += failed
+            timing.seconds += finished - started
+            if self.trace is not None:
+                details.update(copy=copy, failed=failed)
+                self.trace.append(
+                    {
+                        "name": name,
+                        "cat": kind,
+                        "ph": "X",
+                        "ts": (started - self._started) * 1e6,
+                        "dur": (finished - started) * 1e6,
+                        "pid": os.getpid(),
+                        "tid": self._lane(),
+                        "args": details,
+                    }
+                )
+
+    def _lane(self):
+        """Return a number for the task or thread which events happen in.
+
+        Numbers are reused once tasks finish, so the lanes of a trace show
+        how many things were happening at once.
+
+        """
+        task = _current_task()
+        key = threading.get_ident() if task is None else task
+        lane = self._lanes.get(key)
+        if lane is None:
+            used = set(self._lanes.values())
+            lane = next(lane for lane in range(len(used) + 1) if lane not in used)
+            self._lanes[key] = lane
+            if task is not None:
+                task.add_done_callback(lambda _: self._lanes.pop(key, None))
+        return lane
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def report(self, succeeded=True):
+        """Return a JSON serialisable report of the run so far."""
+        return {
+            "started_at": self.started_at,
+            "duration": time.monotonic() - self._started,
+            "succeeded": succeeded,
+            "timings": [
+                dict(kind=kind, name=name, copy=copy, **attr.asdict(timing))
+                for (kind, name, copy), timing in sorted(
+                    self.timings.items(), key=lambda item: _sort_key(item[0])
+                )
+            ],
+            "counters": dict(sorted(self.counters.items())),
+        }
+
+    def write_json(self, path, succeeded=True):
+        _write(path, json.dumps(self.report(succeeded), indent=2) + "\n")
+
+    def write_trace(self, path):
+        """Write the events of the trace as a JSON Trace Event Format file."""
+        _write(
+            path,
+            json.dumps({"traceEvents": self.trace or [], "displayTimeUnit": "ms"}),
+        )
+
+    def write_prometheus(self, path, succeeded=True):
+        """Write the report in the format of the node exporter textfile collector."""
+        report = self.report(succeeded)
+        lines = []
+
+        def metric(name, type_, help_, samples):
+            lines.append("# HELP gitlab_sync_%s %s" % (name, help_))
+            lines.append("# TYPE gitlab_sync_%s %s" % (name, type_))
+            for labels, value in samples:
+                lines.append("gitlab_sync_%s%s %s" % (name, _labels(labels), value))
+
+        metric(
+            "last_run_timestamp_seconds",
+            "gauge",
+            "When the last run started.",
+            [({}, report["started_at"])],
+        )
+        metric(
+            "last_run_duration_seconds",
+            "gauge",
+            "How long the last run took.",
+            [({}, report["duration"])],
+        )
+        metric(
+            "last_run_success",
+            "gauge",
+            "Whether every copy was synchronised by the last run.",
+            [({}, int(succeeded))],
+        )
+        timings = report["timings"]
+        for field, measure in (
+            ("seconds", "Seconds spent on"),
+            ("count", "Number of"),
+            ("failed", "Failures of"),
+        ):
+            metric(
+                "run_%s" % field,
+                "gauge",
+                "%s phases, operations, and git commands in the last run." % measure,
+                [
+                    (
+                        {key: timing[key] for key in ("kind", "name", "copy")},
+                        timing[field],
+                    )
+                    for timing in timings
+                ],
+            )
+        metric(
+            "run_counter",
+            "gauge",
+            "Counts of things done in the last run, like HTTP requests and bytes.",
+            [({"name": name}, value) for name, value in report["counters"].items()],
+        )
+        _write(path, "\n".join(lines) + "\n")
+
+
+def _current_task():
+    try:
+        current_task = asyncio.current_task
+    except AttributeError:
+        # before Python 3.7
+        current_task = asyncio.Task.current_task
+    try:
+        return current_task()
+    except RuntimeError:
+        # no event loop running in this thread
+        return None
+
+
+def _sort_key(key):
+    return tuple("" if part is None else part for part in key)
+
+
+def _labels(labels):
+    labels = {name: value for name, value in labels.items() if value is not None}
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, _escape(str(value))) for name, value in labels.items()
+    )
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _write(path, text):
+    """Write then rename, so collectors never read part of a report.
+
+    mkstemp makes files only the current user can read, so they are given
+    the permissions new files normally get, for collectors run as others.
+
+    """
+    directory = os.path.dirname(os.path.abspath(str(path)))
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as file_:
+            file_.write(text)
+        os.chmod(temp_path, 0o666 & ~_umask())
+        os.replace(temp_path, str(path))
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def _umask():
+    # the umask can only be read by setting it
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
+# the metrics of the current run
+recorder = Metrics()
+
+
+def timed(kind, name, copy=None, **details):
+    return recorder.timed(kind, name, copy, **details)
+
+
+def count(name, value=1):
+    recorder.count(name, value)
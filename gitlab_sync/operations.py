@@ -4,49 +4,142 @@ These operation don't work out what to do at any point, that logic is left to
 the strategy module.
 
 """
+import asyncio
+import collections
+import hashlib
+import json
 import os
+import pathlib
 import shutil
 import subprocess
+import urllib.parse
 
+import gitlab_sync.repository
+import gitlab_sync.state
 from gitlab_sync import logger
 
+# writes to an object pool are made one at a time, including by other copies
+_pool_locks = collections.defaultdict(asyncio.Lock)
+# packs an object pool can have before it is repacked into one
+_POOL_PACKS = 10
 
-def clone(config, local, remote):
-    """Clone a new repository."""
+
+def _remote_url(config, remote):
+    return config.gitlab_git + "%s.git" % remote.gitlab_path
+
+
+async def clone(config, local, remote, pool=None):
+    """Clone a new repository, borrowing objects from a pool if given.
+
+    Returns the branch checked out, as update_local does.
+
+    """
     os.makedirs(str(local.absolute_path))
-    local.git("init", ".")
-    local.gitlab_project_id = remote.gitlab_project_id
-    local.gitlab_path = remote.gitlab_path
-    local.git(
-        "remote", "add", "origin", config.gitlab_git + "%s.git" % remote.gitlab_path
+    await local.git_async("init", ".")
+    if pool is not None:
+        await join_pool(local, pool)
+    await local.set_gitlab_info(remote)
+    await local.git_async("remote", "add", "origin", _remote_url(config, remote))
+    return await update_local(config, local, remote)
+
+
+async def _move_directory(old, new):
+    logger.debug("moving %s to %s", old.absolute_path, new.absolute_path)
+    new.absolute_path.parent.mkdir(parents=True, exist_ok=True)
+    await asyncio.get_event_loop().run_in_executor(
+        None, shutil.move, str(old.absolute_path), str(new.absolute_path)
     )
-    update_local(local)
+    _prune_parents(old)
+
+
+async def move(config, old, new, remote):
+    """Move a repository to a new local path after it has moved on GitLab."""
+    await _move_directory(old, new)
+    await finish_move(config, new, remote)
+
+
+async def finish_move(config, new, remote):
+    """Point a moved repository at its new path on GitLab."""
+    await new.git_async("remote", "set-url", "origin", _remote_url(config, remote))
+    await new.set_gitlab_info(remote)
+
 
+async def remote_heads(config, local, remote):
+    """Return the branch the remote HEAD is on, and the refs fetch would update.
 
-def update_local(local):
-    """Update master from the remote."""
-    local.git("fetch")
+    This only needs the ref advertisement of the remote, so is much cheaper
+    than fetching when nothing has changed.
+
+    """
+    patterns = ["HEAD"]
+    if config.single_branch and remote.default_branch:
+        patterns.append("refs/heads/%s" % remote.default_branch)
+    else:
+        patterns.append("refs/heads/*")
+    result = await local.git_async(
+        "ls-remote",
+        "--symref",
+        "origin",
+        *patterns,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    head = None
+    refs = {}
+    for line in result.stdout.splitlines():
+        value, _, name = line.partition("\t")
+        if value.startswith("ref: refs/heads/") and name == "HEAD":
+            head = value[len("ref: refs/heads/") :]
+        elif name.startswith("refs/heads/"):
+            refs["refs/remotes/origin/" + name[len("refs/heads/") :]] = value
+    return head, refs
+
+
+async def update_local(config, local, remote, head=None):
+    """Update the branch HEAD of the remote points to, from the remote.
+
+    What is fetched and checked out can be trimmed by the single_branch,
+    depth, filter, and sparse_checkout settings of the config. If the branch
+    HEAD is on is already known from remote_heads, it isn't asked for again.
+    Returns the branch checked out, or None for empty projects.
+
+    """
+    # maintenance is scheduled by the strategy rather than left to fetch
+    fetch = ["fetch", "--prune", "--no-auto-gc"]
+    if config.depth:
+        fetch.append("--depth=%d" % config.depth)
+    if config.filter:
+        fetch.append("--filter=%s" % config.filter)
+    branch = head
+    if branch is None and config.single_branch:
+        branch = remote.default_branch
+    # the default branch isn't known for empty projects, so fetch everything
+    if branch and config.single_branch:
+        fetch += ["origin", "+refs/heads/{0}:refs/remotes/origin/{0}".format(branch)]
+    await local.git_async(*fetch)
     # get refs/remotes/origin/HEAD
-    result = local.git(
+    result = await local.git_async(
         "remote",
         "set-head",
         "origin",
-        "--auto",
+        branch or "--auto",
         check=False,
         stderr=subprocess.PIPE,
         universal_newlines=True,
     )
     issue = result.stderr.rstrip()
+    await _set_sparse_checkout(config, local)
     if not result.returncode:
         # read which branch the remote HEAD points to
-        remote_head = local.git(
+        result = await local.git_async(
             "symbolic-ref",
             "refs/remotes/origin/HEAD",
             stdout=subprocess.PIPE,
             universal_newlines=True,
-        ).stdout.rstrip()
+        )
+        remote_head = result.stdout.rstrip()
         # checkout and track the branch that the remote HEAD points to
-        result = local.git(
+        result = await local.git_async(
             "checkout",
             "--track",
             remote_head,
@@ -58,23 +151,47 @@ def update_local(local):
             issue = result.stderr
             # if the branch is already tracked, then just check out the tip of it
             name = remote_head.rpartition("/")[2]
-            if issue.startswith(r"fatal: A branch named '%s' already exists." % name):
-                local.git("reset", "--hard", remote_head)
+            # git lowercased the start of this message in 2.x
+            already_exists = "fatal: a branch named '%s' already exists" % name
+            if issue.lower().startswith(already_exists.lower()):
+                await local.git_async("reset", "--hard", remote_head)
             else:
                 raise Exception(issue.rstrip())
         else:
             logger.debug("`git checkout --track %s` worked", remote_head)
+        branch = remote_head[len("refs/remotes/origin/") :]
     elif issue.endswith("error: Cannot determine remote HEAD"):
         logger.debug("%s is an empty project", local)
+        branch = None
     else:
         raise Exception(issue)
     # mirror only logic
-    local.git("clean", "-d", "--force")
+    await local.git_async("clean", "-d", "--force")
+    return branch
+
+
+async def _set_sparse_checkout(config, local):
+    """Apply the sparse checkout patterns in config, or turn it off."""
+    if config.sparse_checkout:
+        await local.git_async(
+            "sparse-checkout", "set", "--no-cone", *config.sparse_checkout
+        )
+        return
+    patterns = local.absolute_path / ".git" / "info" / "sparse-checkout"
+    if patterns.exists():
+        await local.git_async("sparse-checkout", "disable")
+        # so the next update knows there is nothing to disable
+        patterns.unlink()
 
 
 def delete_local(repo):
     logger.debug("removing %s", repo)
     shutil.rmtree(str(repo.absolute_path))
+    _prune_parents(repo)
+
+
+def _prune_parents(repo):
+    """Remove empty directories left above where a repository was."""
     prune = repo.absolute_path.parent
     while prune != repo.base_path:
         try:
@@ -83,9 +200,276 @@ def delete_local(repo):
             # assuming this is because the directory isn't empty
             break
         logger.debug("pruned %s", prune)
+        prune = prune.parent
+
+
+def object_counts(repo):
+    """Return estimates of the loose objects and the packs in a repository.
+
+    Loose objects are estimated the same way `git gc --auto` does, from how
+    many are in one of the 256 directories they are spread across.
+
+    """
+    objects = repo.absolute_path / ".git" / "objects"
+    if not objects.exists():
+        # object pools are bare repositories
+        objects = repo.absolute_path / "objects"
+    try:
+        loose = sum(1 for path in (objects / "17").iterdir() if len(path.name) == 38)
+    except FileNotFoundError:
+        loose = 0
+    try:
+        packs = sum(1 for path in (objects / "pack").glob("*.pack"))
+    except FileNotFoundError:
+        packs = 0
+    return loose * 256, packs
+
+
+async def maintain(repo):
+    """Run the cheap maintenance tasks which keep a repository quick to use."""
+    logger.debug("maintaining %s", repo)
+    tasks = ["--task=loose-objects", "--task=commit-graph"]
+    # incremental-repack fails without packs, and has nothing to combine in one
+    if object_counts(repo)[1] > 1:
+        tasks.append("--task=incremental-repack")
+    await repo.git_async("maintenance", "run", *tasks)
+
+
+async def repack(repo):
+    """Repack a repository into one pack, pruning unreachable objects."""
+    logger.debug("repacking %s", repo)
+    await repo.git_async("gc", "--quiet")
+
+
+async def maintain_pool(pool):
+    """Maintain an object pool, repacking it when it has many packs.
+
+    Repacks prune objects which no member has refs to any more.
+
+    """
+    async with _pool_locks[pool.absolute_path]:
+        if object_counts(pool)[1] >= _POOL_PACKS:
+            await repack(pool)
+        else:
+            await maintain(pool)
+
+
+def object_pool(config, remote):
+    """Return the object pool a repository should borrow objects from, or None.
+
+    Forks share a pool with the project they were forked from, so objects
+    common to them are only stored and downloaded once. Projects GitLab says
+    have no forks, and aren't forks themselves, have nothing to share. GitLab
+    only gives the project a fork was forked from directly, so forks of forks
+    use the pool of their parent rather than the one of the whole fork
+    network.
+
+    """
+    if remote.forked_from_id is None and remote.forks_count == 0:
+        return None
+    host = urllib.parse.urlsplit(config.gitlab_http).netloc
+    project_id = remote.forked_from_id or remote.gitlab_project_id
+    return gitlab_sync.repository.LocalRepository(
+        config.object_pool, pathlib.Path(host) / ("%d.git" % project_id)
+    )
+
+
+def joined_pool(config, local):
+    """Return the pool under config.object_pool a repository borrows from."""
+    alternates = local.absolute_path / ".git" / "objects" / "info" / "alternates"
+    try:
+        lines = alternates.read_text().splitlines()
+    except FileNotFoundError:
+        return None
+    for line in lines:
+        objects = pathlib.Path(line)
+        if config.object_pool in objects.parents:
+            return gitlab_sync.repository.LocalRepository(
+                config.object_pool, objects.parent.relative_to(config.object_pool)
+            )
+    return None
+
+
+async def join_pool(local, pool):
+    """Borrow objects from a pool, creating the pool if needed.
+
+    Objects only reachable from reflogs aren't kept in the pool, so reflogs
+    are turned off to stop git using objects the pool may later prune.
+
+    """
+    async with _pool_locks[pool.absolute_path]:
+        if not pool.absolute_path.exists():
+            logger.debug("creating object pool %s", pool.absolute_path)
+            os.makedirs(str(pool.absolute_path))
+            await pool.git_async("init", "--bare")
+            # members only drop loose objects the pool has packed
+            await pool.git_async("config", "fetch.unpackLimit", "1")
+    logger.debug("%s joining object pool %s", local, pool.absolute_path)
+    await local.git_async("config", "core.logAllRefUpdates", "false")
+    shutil.rmtree(str(local.absolute_path / ".git" / "logs"), ignore_errors=True)
+    alternates = local.absolute_path / ".git" / "objects" / "info" / "alternates"
+    alternates.parent.mkdir(exist_ok=True)
+    with alternates.open("a") as file_:
+        file_.write("%s\n" % (pool.absolute_path / "objects"))
+
+
+def _member_namespace(local):
+    """Return where refs of a repository are kept in its pool."""
+    copy = hashlib.sha1(str(local.base_path).encode()).hexdigest()[:12]
+    return "refs/members/%s/%d/" % (copy, local.gitlab_project_id)
+
+
+async def share_objects(local, pool):
+    """Copy new objects from a repository into its pool.
+
+    The pool keeps refs for every member, so repacking it never drops
+    objects a member repository relies on.
+
+    """
+    namespace = _member_namespace(local)
+    async with _pool_locks[pool.absolute_path]:
+        await pool.git_async(
+            "fetch",
+            "--no-tags",
+            "--prune",
+            str(local.absolute_path),
+            "+refs/*:%s*" % namespace,
+        )
+
+
+async def drop_pooled_objects(local):
+    """Remove objects from a repository which it can borrow from its pool.
+
+    Repositories fetch everything before they join a pool or share objects
+    with it, so until this they keep a copy of what the pool has.
+
+    """
+    await local.git_async("repack", "-a", "-d", "-l", "-q")
+
+
+async def leave_pool(local, pool):
+    """Drop the refs a repository has in its pool before it is deleted.
+
+    Objects only it used can be pruned from the pool after this, which is
+    safe as nothing else borrows them.
+
+    """
+    namespace = _member_namespace(local)
+    async with _pool_locks[pool.absolute_path]:
+        result = await pool.git_async(
+            "for-each-ref",
+            "--format=delete %(refname)",
+            namespace,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        if result.stdout:
+            await pool.git_async(
+                "update-ref", "--stdin", input=result.stdout, universal_newlines=True
+            )
+
+
+async def snapshot_head(session, config, remote):
+    """Return the commit at the head of the default branch of a project.
+
+    None is returned for empty projects, which have no default branch.
+
+    """
+    if not remote.default_branch:
+        return None
+    url = "{}api/v4/projects/{}/repository/branches/{}".format(
+        config.gitlab_http,
+        remote.gitlab_project_id,
+        urllib.parse.quote(remote.default_branch, safe=""),
+    )
+    async with session.get(url) as response:
+        if response.status == 404:
+            return None
+        response.raise_for_status()
+        return (await response.json())["commit"]["id"]
+
+
+def _write_snapshot_marker(path, remote, commit):
+    with (path / gitlab_sync.repository.SNAPSHOT_MARKER).open("w") as file_:
+        json.dump(
+            {
+                "project-id": remote.gitlab_project_id,
+                "gitlab-path": str(remote.gitlab_path),
+                "commit": commit,
+            },
+            file_,
+        )
+
+
+async def download_snapshot(session, config, local, remote, commit):
+    """Replace a snapshot with the archive of a commit from GitLab.
+
+    The archive is streamed into tar as it is downloaded, and extracted in
+    the state directory so the old snapshot is only replaced once the new one
+    is complete.
+
+    """
+    temp_path = (
+        config.base_path
+        / gitlab_sync.state.STATE_DIRECTORY
+        / "snapshots"
+        / str(remote.gitlab_project_id)
+    )
+    old_path = temp_path.with_name(temp_path.name + ".old")
+    # either may be left behind by a run which was killed
+    shutil.rmtree(str(temp_path), ignore_errors=True)
+    shutil.rmtree(str(old_path), ignore_errors=True)
+    temp_path.mkdir(parents=True)
+    try:
+        if commit is not None:
+            await _extract_archive(session, config, remote, commit, temp_path)
+        _write_snapshot_marker(temp_path, remote, commit)
+        if local.absolute_path.exists():
+            os.rename(str(local.absolute_path), str(old_path))
+        else:
+            local.absolute_path.parent.mkdir(parents=True, exist_ok=True)
+        os.rename(str(temp_path), str(local.absolute_path))
+    finally:
+        shutil.rmtree(str(temp_path), ignore_errors=True)
+    shutil.rmtree(str(old_path), ignore_errors=True)
+
+
+async def _extract_archive(session, config, remote, commit, path):
+    url = "{}api/v4/projects/{}/repository/archive.tar.gz".format(
+        config.gitlab_http, remote.gitlab_project_id
+    )
+    # archives have everything in one top level directory
+    process = await asyncio.create_subprocess_exec(
+        "tar",
+        "-xz",
+        "--strip-components=1",
+        "-C",
+        str(path),
+        stdin=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    try:
+        async with session.get(url, params={"sha": commit}) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                process.stdin.write(chunk)
+                await process.stdin.drain()
+        process.stdin.close()
+        _, stderr = await process.communicate()
+    except BaseException:
+        process.kill()
+        await process.wait()
+        raise
+    if process.returncode:
+        raise Exception(
+            "extracting the archive of %s failed: %s"
+            % (remote, stderr.decode(errors="replace").rstrip())
+        )
 
 
-def clean(repo):
-    logger.debug("cleaning %s", repo)
-    repo.git("remote", "prune", "origin")
-    repo.git("gc", "--auto")
+async def move_snapshot(old, new, remote):
+    """Move a snapshot to a new local path after it has moved on GitLab."""
+    await _move_directory(old, new)
+    with (new.absolute_path / gitlab_sync.repository.SNAPSHOT_MARKER).open() as file_:
+        commit = json.load(file_)["commit"]
+    _write_snapshot_marker(new.absolute_path, remote, commit)
@@ -2,16 +2,35 @@
 
 """
 import asyncio
+import collections
+import datetime
+import json
 import os
 import pathlib
+import re
 import subprocess
 import attr
 import typing
 
-import aiohttp
 import gitlab_sync
+import gitlab_sync.api
+import gitlab_sync.cache
+import gitlab_sync.metrics
+import gitlab_sync.state
 
 _DEV_NULL = open(os.devnull, "r+b")
+# file in each snapshot recording what it is a snapshot of
+SNAPSHOT_MARKER = ".gitlab-sync-snapshot"
+# the most items GitLab will return in a page
+_PER_PAGE = 100
+
+
+def _log_output(repo, output):
+    """Log output from git, prefixed with the repository it came from."""
+    if isinstance(output, bytes):
+        output = output.decode(errors="replace")
+    for line in output.splitlines():
+        gitlab_sync.logger.debug("%s: %s", repo.relative_path, line)
 
 
 @attr.s(auto_attribs=True)
@@ -23,14 +42,80 @@ class LocalRepository:
     def absolute_path(self):
         return self.base_path / self.relative_path
 
+    def _git_command(self, git_args):
+        return ["git", "-C", str(self.absolute_path)] + list(git_args)
+
+    def _default_streams(self, run_kwargs):
+        """Set where uncaptured output goes, returning the streams to log."""
+        teed = []
+        for stream in ("stdout", "stderr"):
+            if stream not in run_kwargs:
+                if gitlab_sync.tee_git:
+                    run_kwargs[stream] = subprocess.PIPE
+                    teed.append(stream)
+                else:
+                    run_kwargs[stream] = _DEV_NULL
+        return teed
+
+    def _default_env(self, run_kwargs):
+        """Share SSH connections if a multiplexer is in use."""
+        if gitlab_sync.ssh_multiplexer is not None and "env" not in run_kwargs:
+            run_kwargs["env"] = gitlab_sync.ssh_multiplexer.environment()
+
+    def _finish_git(self, result, teed, check):
+        for stream in teed:
+            _log_output(self, getattr(result, stream))
+        if check:
+            result.check_returncode()
+        return result
+
     def git(self, *git_args, **run_kwargs):
-        """Run a command in git using `subprocess.run` where `check=True` by default."""
-        run_kwargs.setdefault("check", True)
-        if not gitlab_sync.tee_git:
-            run_kwargs.setdefault("stdout", _DEV_NULL)
-            run_kwargs.setdefault("stderr", _DEV_NULL)
-        command = ["git", "-C", str(self.absolute_path)] + list(git_args)
-        return subprocess.run(command, **run_kwargs)
+        """Run a command in git using `subprocess.run` where `check=True` by default.
+
+        When tee_git is set, output which the caller doesn't capture is logged
+        line by line against this repository, so that output from commands
+        running concurrently in other repositories isn't interleaved.
+
+        """
+        check = run_kwargs.pop("check", True)
+        teed = self._default_streams(run_kwargs)
+        self._default_env(run_kwargs)
+        command = self._git_command(git_args)
+        with gitlab_sync.metrics.timed(
+            "git", git_args[0], self.base_path, argv=command
+        ):
+            result = subprocess.run(command, **run_kwargs)
+        return self._finish_git(result, teed, check)
+
+    async def git_async(
+        self, *git_args, check=True, universal_newlines=False, input=None, **kwargs
+    ):
+        """Run a command in git as an asyncio subprocess.
+
+        Takes the same stdout, stderr, check, input, and universal_newlines
+        arguments as git, and returns a `subprocess.CompletedProcess` in the
+        same way.
+
+        """
+        teed = self._default_streams(kwargs)
+        self._default_env(kwargs)
+        command = self._git_command(git_args)
+        if input is not None:
+            kwargs["stdin"] = subprocess.PIPE
+            if universal_newlines:
+                input = input.encode()
+        with gitlab_sync.metrics.timed(
+            "git", git_args[0], self.base_path, argv=command
+        ):
+            process = await asyncio.create_subprocess_exec(*command, **kwargs)
+            stdout, stderr = await process.communicate(input)
+        if universal_newlines:
+            stdout = stdout if stdout is None else stdout.decode()
+            stderr = stderr if stderr is None else stderr.decode()
+        result = subprocess.CompletedProcess(
+            command, process.returncode, stdout, stderr
+        )
+        return self._finish_git(result, teed, check)
 
     def _get_gitlab_project_id(self):
         if not hasattr(self, "_gitlab_project_id"):
@@ -75,6 +160,28 @@ class LocalRepository:
     gitlab_project_id = property(_get_gitlab_project_id, _set_gitlab_project_id)
     gitlab_path = property(_get_gitlab_path, _set_gitlab_path)
 
+    async def set_gitlab_info(self, remote):
+        """Record the GitLab project id and path of a remote repository."""
+        await self.git_async(
+            "config", "--local", "gitlab-sync.project-id", str(remote.gitlab_project_id)
+        )
+        self._gitlab_project_id = remote.gitlab_project_id
+        await self.git_async(
+            "config", "--local", "gitlab-sync.gitlab-path", str(remote.gitlab_path)
+        )
+        self._gitlab_path = remote.gitlab_path
+
+    async def remote_refs(self):
+        """Return a map of the remote tracking refs of origin to their commits."""
+        result = await self.git_async(
+            "for-each-ref",
+            "--format=%(refname) %(objectname)",
+            "refs/remotes/origin",
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        return dict(line.split(" ", 1) for line in result.stdout.splitlines())
+
     def __str__(self):
         return str(self.gitlab_path)
 
@@ -90,6 +197,16 @@ class LocalRepository:
             relative_path = remote.gitlab_path
         instance = cls(config.base_path, relative_path)
         instance._gitlab_path = remote.gitlab_path
+        if remote.gitlab_project_id is not None:
+            instance._gitlab_project_id = remote.gitlab_project_id
+        return instance
+
+    @classmethod
+    def from_entry(cls, base_path, entry):
+        """Return an instance for an entry in a StateIndex."""
+        instance = cls(base_path, entry.relative_path)
+        instance._gitlab_project_id = entry.project_id
+        instance._gitlab_path = entry.gitlab_path
         return instance
 
 
@@ -97,6 +214,13 @@ class LocalRepository:
 class GitlabRepository:
     gitlab_path: pathlib.Path
     gitlab_project_id: typing.Optional[int] = None
+    last_activity_at: typing.Optional[str] = None
+    default_branch: typing.Optional[str] = None
+    forked_from_id: typing.Optional[int] = None
+    # None if GitLab didn't say
+    forks_count: typing.Optional[int] = None
+    # in bytes, if GitLab gave project statistics
+    repository_size: typing.Optional[int] = None
 
     def __str__(self):
         return str(self.gitlab_path)
@@ -112,21 +236,289 @@ class RemoteRepository:
     gitlab_project_id: typing.Optional[int] = None
 
 
-def enumerate_local(base_path):
-    """Return all local repositories under a given path."""
-    for root, dirs, files in os.walk(base_path):
-        if ".git" not in dirs:
+def _read_gitlab_config(path):
+    """Return the gitlab-sync.* values in a git config file.
+
+    Only the simple config written by git for gitlab-sync is understood, so
+    None is returned if the file uses includes, quoting, or escapes, and git
+    has to be asked instead.
+
+    """
+    values = {}
+    section = None
+    try:
+        with open(path) as file_:
+            lines = file_.readlines()
+    except (OSError, UnicodeDecodeError):
+        return None
+    for line in lines:
+        line = line.strip()
+        if not line or line[0] in "#;":
+            continue
+        if line.startswith("["):
+            section = line[1 : line.find("]")].strip().lower()
+            if section.startswith("include"):
+                return None
+            continue
+        if section != "gitlab-sync":
+            continue
+        if '"' in line or "\\" in line:
+            return None
+        key, _, value = line.partition("=")
+        values[key.strip().lower()] = value.split("#")[0].split(";")[0].strip()
+    return values
+
+
+def _scan(base_path, marker=".git"):
+    """Yield the paths of directories containing a marker entry under base_path.
+
+    Directories aren't descended into once they are found to be repositories,
+    and neither is the state directory, or symlinks to directories.
+
+    """
+    stack = [base_path]
+    while stack:
+        path = stack.pop()
+        try:
+            with os.scandir(str(path)) as entries:
+                subdirectories = []
+                for entry in entries:
+                    if entry.name == marker:
+                        yield path
+                        break
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.name)
+                else:
+                    if path == base_path:
+                        subdirectories = [
+                            name
+                            for name in subdirectories
+                            if name != gitlab_sync.state.STATE_DIRECTORY
+                        ]
+                    # reversed, so they are popped in order
+                    stack.extend(path / name for name in sorted(subdirectories)[::-1])
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
             continue
-        del dirs[:]
-        store_path = pathlib.Path(root).relative_to(base_path)
+
+
+def enumerate_local(base_path, index=None):
+    """Return all local repositories under a given path.
+
+    If a StateIndex is given, the GitLab details of repositories are taken
+    from it. Otherwise they are read from .git/config in process, and only
+    read by running git if that can't be done. Repositories missing from the
+    index are added, and once all repositories have been yielded, entries for
+    ones which no longer exist are removed.
+
+    """
+    entries = {} if index is None else index.entries()
+    for path in _scan(base_path):
+        store_path = path.relative_to(base_path)
         repo = LocalRepository(base_path, store_path)
+        entry = entries.pop(store_path, None)
+        if entry is not None:
+            repo = LocalRepository.from_entry(base_path, entry)
+            yield repo
+            continue
+        values = _read_gitlab_config(path / ".git" / "config")
+        if values is not None:
+            project_id = values.get("project-id")
+            gitlab_path = values.get("gitlab-path")
+            repo._gitlab_project_id = int(project_id) if project_id else None
+            repo._gitlab_path = pathlib.Path(gitlab_path) if gitlab_path else None
+        if index is not None and repo.gitlab_project_id is not None:
+            index.add(repo)
         yield repo
+    if index is not None and entries:
+        index.remove(entries)
+
+
+def enumerate_snapshots(base_path, index=None):
+    """Return all snapshots under a given path, read from their marker files.
+
+    The commit of each snapshot is kept in the index as refs["HEAD"], so
+    snapshots missing from the index are added with it. As for repositories,
+    entries for snapshots which no longer exist are removed.
+
+    """
+    entries = {} if index is None else index.entries()
+    for path in _scan(base_path, SNAPSHOT_MARKER):
+        with (path / SNAPSHOT_MARKER).open() as file_:
+            marker = json.load(file_)
+        repo = LocalRepository(base_path, path.relative_to(base_path))
+        repo._gitlab_project_id = marker["project-id"]
+        repo._gitlab_path = pathlib.Path(marker["gitlab-path"])
+        if index is not None and entries.pop(repo.relative_path, None) is None:
+            index.update(repo, refs={"HEAD": marker["commit"]})
+        yield repo
+    if index is not None and entries:
+        index.remove(entries)
+
+
+def in_paths(gitlab_path, paths):
+    """Return True if a GitLab path is one of, or under one of, the given paths."""
+    parts = gitlab_path.parts
+    return any(parts[: len(path.parts)] == path.parts for path in paths)
+
+
+def overlaps(path, paths):
+    """Return True if a path is in, contains, or is one of the given paths."""
+    return in_paths(path, paths) or any(in_paths(other, [path]) for other in paths)
+
+
+def parse_time(value):
+    """Return the timestamp for an ISO 8601 time from GitLab."""
+    value = re.sub(r"(?:Z|([+-]\d\d):?(\d\d))$", r"\1\2", value)
+    if value[-5:-4] not in "+-":
+        value += "+0000"
+    format_ = "%Y-%m-%dT%H:%M:%S.%f%z" if "." in value else "%Y-%m-%dT%H:%M:%S%z"
+    return datetime.datetime.strptime(value, format_).timestamp()
 
 
 class NotAGroup(Exception):
     pass
 
 
+_GROUP_PROJECTS_QUERY = (
+    """
+query($fullPath: ID!, $after: String) {
+  group(fullPath: $fullPath) {
+    projects(includeSubgroups: true, first: %d, after: $after) {
+      pageInfo { hasNextPage endCursor }
+      nodes { id fullPath lastActivityAt repository { rootRef } }
+    }
+  }
+}
+"""
+    % _PER_PAGE
+)
+
+
+_PROJECT_HEADS_QUERY = (
+    """
+query($ids: [ID!]) {
+  projects(ids: $ids, first: %d) {
+    nodes { id repository { rootRef tree { lastCommit { sha } } } }
+  }
+}
+"""
+    % _PER_PAGE
+)
+
+
+class HeadLoader(object):
+    """Loads the default branch and its head commit for projects in batches.
+
+    Projects asked for in the same iteration of the event loop are looked up
+    together, up to a page at a time, in one GraphQL query.
+
+    """
+
+    def __init__(self, config, session):
+        self.config = config
+        self.session = session
+        self._futures = {}
+        self._pending = collections.OrderedDict()
+        self._handle = None
+        # batches being loaded, kept so they aren't garbage collected
+        self._tasks = set()
+
+    def load(self, project_id) -> "asyncio.Future":
+        """Return a future for the (default branch, head commit) of a project.
+
+        The result is None for projects GitLab doesn't say either of.
+
+        """
+        future = self._futures.get(project_id)
+        if future is None:
+            future = asyncio.get_event_loop().create_future()
+            self._futures[project_id] = self._pending[project_id] = future
+            if len(self._pending) >= _PER_PAGE:
+                self._flush()
+            elif self._handle is None:
+                self._handle = asyncio.get_event_loop().call_soon(self._flush)
+        return future
+
+    def _flush(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        batch, self._pending = self._pending, collections.OrderedDict()
+        task = asyncio.ensure_future(self._load_batch(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _load_batch(self, batch):
+        try:
+            data = await gitlab_sync.api.graphql(
+                self.session,
+                self.config,
+                _PROJECT_HEADS_QUERY,
+                ids=["gid://gitlab/Project/%d" % id_ for id_ in batch],
+            )
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        heads = {}
+        for node in data["projects"]["nodes"]:
+            repository = node["repository"] or {}
+            commit = (repository.get("tree") or {}).get("lastCommit") or {}
+            if repository.get("rootRef") and commit.get("sha"):
+                heads[int(node["id"].rpartition("/")[2])] = (
+                    repository["rootRef"],
+                    commit["sha"],
+                )
+        for id_, future in batch.items():
+            if not future.done():
+                future.set_result(heads.get(id_))
+
+
+def _project_from_node(node):
+    """Return a project from GraphQL in the form the REST API gives it."""
+    return {
+        "id": int(node["id"].rpartition("/")[2]),
+        "path_with_namespace": node["fullPath"],
+        "last_activity_at": node["lastActivityAt"],
+        "default_branch": (node["repository"] or {}).get("rootRef"),
+    }
+
+
+def _repository(project):
+    """Return a GitlabRepository for a project from the REST API."""
+    return GitlabRepository(
+        pathlib.Path(project["path_with_namespace"]),
+        project["id"],
+        project.get("last_activity_at"),
+        project.get("default_branch"),
+        (project.get("forked_from_project") or {}).get("id"),
+        project.get("forks_count"),
+        (project.get("statistics") or {}).get("repository_size"),
+    )
+
+
+async def get_project(session, config, project_id):
+    """Return the repository of a project, or None if GitLab has no such project."""
+    url = "{}api/v4/projects/{}".format(config.gitlab_http, project_id)
+    async with session.get(url) as response:
+        if response.status == 404:
+            return None
+        if response.status >= 400:
+            raise gitlab_sync.api.ApiError(
+                await gitlab_sync.api.error_message(response)
+            )
+        return _repository(await response.json())
+
+
+def _listing(path, data):
+    """Return a listing from GitLab, raising ApiError if it isn't one."""
+    if not isinstance(data, list):
+        message = data.get("message") if isinstance(data, dict) else data
+        raise gitlab_sync.api.ApiError("{}: {}".format(path, message))
+    return data
+
+
 class ProjectCollector(object):
     """
     Class to collect Repositories from GitLab using asynchronous HTTP
@@ -134,138 +526,403 @@ class ProjectCollector(object):
 
     """
 
-    def __init__(self, config):
+    def __init__(self, config, simple=None, since=None):
         self.config = config
+        # if given, only projects active since this timestamp are listed
+        self.since = since
+        # simple listings leave out details only needed for object pools, and
+        # statistics, which are only given when asked for
+        if simple is None:
+            simple = config.object_pool is None
+        self._project_params = {"simple": 1} if simple else {}
+        if config.project_statistics:
+            self._project_params = {"statistics": "true"}
+        self.cache = None
+        if config.http_cache:
+            self.cache = gitlab_sync.cache.HttpCache(
+                gitlab_sync.cache.default_directory(),
+                config.http_cache_size * 1024 * 1024,
+            )
 
     def filter_projects(self, projects):
         """Yield repository objects for projects of interest."""
         for project in projects:
-            path = pathlib.Path(project["path_with_namespace"]).parts
-            for filter_path in self.config.paths:
-                filter_parts = filter_path.parts
-                if path[: len(filter_parts)] == filter_parts:
-                    yield GitlabRepository(
-                        pathlib.Path(project["path_with_namespace"]), project["id"]
-                    )
-                    break
+            path = pathlib.Path(project["path_with_namespace"])
+            if in_paths(path, self.config.paths):
+                yield _repository(project)
             else:
                 gitlab_sync.logger.debug(
-                    "Skipping %s as it does not match a filter path",
-                    project["path_with_namespace"],
+                    "Skipping %s as it does not match a filter path", path
                 )
 
-    async def _get_user_projects(self, user):
-        projects = []
-        async with self.session.get(
-            "{}api/v4/users/{}/projects".format(self.config.gitlab_http, user),
-            params={"per_page": 100, "page": 1, "simple": 1},
-        ) as response:
-            projects.extend(await response.json())
-            next_page = response.headers.get("X-Next-Page")
-
-        while next_page:
-            async with self.session.get(
-                "{}api/v4/users/{}/projects".format(self.config.gitlab_http, user),
-                params={"per_page": 100, "page": next_page, "simple": 1},
-            ) as response:
-                projects.extend(await response.json())
-                next_page = response.headers.get("X-Next-Page")
-
-        return self.filter_projects(projects)
+    async def _get_page(self, url, params):
+        """Return the data and headers of a response from the GitLab API.
 
-    async def _get_group_projects(self, group):
-        projects = []
-        async with self.session.get(
-            "{}api/v4/groups/{}/projects".format(self.config.gitlab_http, group),
-            params={"per_page": 100, "page": 1, "simple": 1},
-        ) as response:
+        Responses are cached, and a cached response is used if GitLab confirms
+        that its ETag is still current.
+
+        """
+        cached = key = None
+        headers = {}
+        if self.cache is not None:
+            key = self.cache.key(url, params, self.config.access_token)
+            cached = self.cache.get(key)
+            if cached is not None:
+                headers["If-None-Match"] = cached.etag
+        async with self.session.get(url, params=params, headers=headers) as response:
+            if response.status == 304 and cached is not None:
+                return cached.data, cached.headers
+            # not found is left to callers, as it is how users are told apart
+            if response.status >= 400 and response.status != 404:
+                raise gitlab_sync.api.ApiError(
+                    await gitlab_sync.api.error_message(response)
+                )
             data = await response.json()
-            projects.extend(data)
-            next_page = response.headers.get("X-Next-Page")
+            etag = response.headers.get("ETag")
+            if key is not None and etag and response.status == 200:
+                self.cache.put(key, etag, response.headers, data)
+            return data, response.headers
+
+    async def _paginate(self, path, keyset=False, **params):
+        """Yield the data of each page of a listing from the GitLab API.
 
-        while next_page:
-            async with self.session.get(
-                "{}api/v4/groups/{}/projects".format(self.config.gitlab_http, group),
-                params={"per_page": 100, "page": next_page, "simple": 1},
-            ) as response:
-                projects.extend(await response.json())
-                next_page = response.headers.get("X-Next-Page")
+        When GitLab gives the number of pages, all the pages after the first
+        are requested at once and yielded as they arrive. GitLab leaves it out
+        for large listings, in which case pages are followed one after another,
+        using id_after to page through listings which support it in keyset
+        order, rather than counting offsets.
+
+        """
+        url = "{}api/v4/{}".format(self.config.gitlab_http, path)
+        params["per_page"] = _PER_PAGE
+        if keyset:
+            params.update(order_by="id", sort="asc")
+        data, headers = await self._get_page(url, dict(params, page=1))
+        yield data
+
+        total_pages = headers.get("X-Total-Pages")
+        if total_pages:
+            tasks = [
+                asyncio.ensure_future(self._get_page(url, dict(params, page=page)))
+                for page in range(2, int(total_pages) + 1)
+            ]
+            try:
+                for task in asyncio.as_completed(tasks):
+                    data, _ = await task
+                    yield data
+            finally:
+                for task in tasks:
+                    task.cancel()
+        elif keyset:
+            while isinstance(data, list) and len(data) == _PER_PAGE:
+                cursor = data[-1]["id"]
+                data, _ = await self._get_page(url, dict(params, id_after=cursor))
+                if isinstance(data, list) and data and data[-1]["id"] <= cursor:
+                    # a page which doesn't move on would be followed forever
+                    break
+                yield data
+        else:
+            next_page = headers.get("X-Next-Page")
+            while next_page:
+                data, headers = await self._get_page(url, dict(params, page=next_page))
+                next_page = headers.get("X-Next-Page")
+                yield data
 
-        return self.filter_projects(projects)
+    async def _get_user_projects(self, user):
+        """Yield lists of repositories for each page of a user's projects."""
+        path = "users/{}/projects".format(user)
+        async for projects in self._paginate(path, keyset=True, **self._project_params):
+            yield list(self.filter_projects(_listing(path, projects)))
+
+    async def _get_group_projects(self, group):
+        """Yield lists of repositories for each page of a group's projects."""
+        path = "groups/{}/projects".format(group)
+        async for projects in self._paginate(path, keyset=True, **self._project_params):
+            yield list(self.filter_projects(_listing(path, projects)))
 
     async def _get_group_subgroups(self, group):
         """Yields a (sub)group names/ids"""
-        groups = []
-        async with self.session.get(
-            "{}api/v4/groups/{}/subgroups".format(self.config.gitlab_http, group),
-            params={"per_page": 100, "page": 1},
-        ) as response:
-            data = await response.json()
+        groups = None
+        async for data in self._paginate("groups/{}/subgroups".format(group)):
             if not isinstance(data, list):
                 raise NotAGroup()
+            if groups is None:
+                # yield the given group when we know it isn't a user
+                yield group
+                groups = []
             groups.extend(data)
-            next_page = response.headers.get("X-Next-Page")
-        # yield the given group when we know it isn't a user
-        yield group
-
-        while next_page:
-            async with self.session.get(
-                "{}api/v4/groups/{}/subgroups".format(self.config.gitlab_http, group),
-                params={"per_page": 100, "page": next_page},
-            ) as response:
-                data = await response.json()
-                groups.extend(data)
-                next_page = response.headers.get("X-Next-Page")
 
         for group_data in groups:
-            yield group_data["id"]
+            # the recursive call yields the subgroup itself first
             async for subgroup_id in self._get_group_subgroups(group_data["id"]):
                 yield subgroup_id
 
-    async def _get_entity_projects(self, entity):
-        try:
-            projects = []
-            for projects_future in asyncio.as_completed(
-                [
-                    asyncio.ensure_future(self._get_group_projects(group))
-                    async for group in self._get_group_subgroups(entity)
-                ]
-            ):
-                projects.extend(await projects_future)
-            return projects
-        except NotAGroup:
-            pass
-        return await self._get_user_projects(entity)
-
-    async def _get_paths(self, paths):
-        entities = {path.parts[0] for path in paths}
-        all_paths = []
-        async with aiohttp.ClientSession(
-            headers={"Private-Token": self.config.access_token}
-        ) as self.session:
-            paths_futures = []
-            for paths_future in asyncio.as_completed(
-                [
-                    asyncio.ensure_future(self._get_entity_projects(entity))
-                    for entity in entities
-                ]
-            ):
-                paths_futures.append(paths_future)
-            for paths in asyncio.as_completed(paths_futures):
-                all_paths.extend(await paths)
-        return all_paths
+    async def _get_active_projects(self, path, **params):
+        """Yield the data of each page of a listing of projects active since.
+
+        Projects are listed most recently active first, and pages are followed
+        only until a project without activity since then, so the pages asked
+        for go with how many projects changed rather than how many there are.
+        Servers which know last_activity_after leave the rest out themselves.
+
+        """
+        url = "{}api/v4/{}".format(self.config.gitlab_http, path)
+        since = datetime.datetime.fromtimestamp(self.since, datetime.timezone.utc)
+        params.update(
+            self._project_params,
+            per_page=_PER_PAGE,
+            order_by="last_activity_at",
+            sort="desc",
+            last_activity_after=since.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        )
+        page = 1
+        while page:
+            data, headers = await self._get_page(url, dict(params, page=page))
+            if not isinstance(data, list):
+                yield data
+                return
+            active = [
+                project
+                for project in data
+                if not project.get("last_activity_at")
+                or parse_time(project["last_activity_at"]) >= self.since
+            ]
+            yield active
+            if len(active) < len(data):
+                return
+            page = headers.get("X-Next-Page")
+
+    async def _put_active_projects(self, entity, queue):
+        """Put lists of repositories under a group or user active since on a queue."""
+        with gitlab_sync.metrics.timed("phase", "list_projects", entity=entity):
+            path = "groups/{}/projects".format(entity)
+            try:
+                async for projects in self._get_active_projects(
+                    path, include_subgroups="true"
+                ):
+                    if not isinstance(projects, list):
+                        raise NotAGroup()
+                    queue.put_nowait(list(self.filter_projects(projects)))
+                return
+            except NotAGroup:
+                pass
+            path = "users/{}/projects".format(entity)
+            async for projects in self._get_active_projects(path):
+                queue.put_nowait(list(self.filter_projects(_listing(path, projects))))
+
+    async def _put_pages(self, pages, queue):
+        async for page in pages:
+            queue.put_nowait(page)
+
+    async def _put_entity_projects(self, entity, queue):
+        """Put lists of repositories under a group or user on a queue."""
+        engine = self.config.enumeration
+        with gitlab_sync.metrics.timed("phase", "list_projects", entity=entity):
+            try:
+                if engine == "graphql":
+                    await self._put_pages(self._get_graphql_projects(entity), queue)
+                elif engine == "traverse":
+                    await self._put_subgroup_projects(entity, queue)
+                else:
+                    await self._put_descendant_projects(
+                        entity, queue, verify=engine == "auto"
+                    )
+                return
+            except NotAGroup:
+                pass
+            await self._put_pages(self._get_user_projects(entity), queue)
+
+    async def _put_subgroup_projects(self, group, queue, skip_group=False):
+        """Put lists of repositories on a queue by walking a group's subgroups."""
+        tasks = []
+        async for subgroup in self._get_group_subgroups(group):
+            if skip_group and subgroup == group:
+                continue
+            # start on the projects of groups as soon as they are found
+            tasks.append(
+                asyncio.ensure_future(
+                    self._put_pages(self._get_group_projects(subgroup), queue)
+                )
+            )
+        await asyncio.gather(*tasks)
+
+    async def _put_descendant_projects(self, group, queue, verify):
+        """Put lists of repositories in a group and its subgroups on a queue.
+
+        This lists every project with include_subgroups, rather than listing
+        the projects of each subgroup. Old servers ignore include_subgroups, so
+        when verifying, if no projects of subgroups were listed, the subgroups
+        are walked to be sure none were missed.
+
+        """
+        group_path = pathlib.Path(group)
+        from_subgroups = False
+        async for projects in self._paginate(
+            "groups/{}/projects".format(group),
+            keyset=True,
+            include_subgroups="true",
+            **self._project_params
+        ):
+            if not isinstance(projects, list):
+                raise NotAGroup()
+            from_subgroups = from_subgroups or any(
+                pathlib.Path(project["path_with_namespace"]).parent != group_path
+                for project in projects
+            )
+            queue.put_nowait(list(self.filter_projects(projects)))
+        if verify and not from_subgroups:
+            await self._put_subgroup_projects(group, queue, skip_group=True)
+
+    async def _graphql(self, query, **variables):
+        return await gitlab_sync.api.graphql(
+            self.session, self.config, query, **variables
+        )
+
+    async def _get_graphql_projects(self, group):
+        """Yield lists of repositories for each page of a group's descendants."""
+        after = None
+        while True:
+            data = await self._graphql(
+                _GROUP_PROJECTS_QUERY, fullPath=group, after=after
+            )
+            if data["group"] is None:
+                raise NotAGroup()
+            projects = data["group"]["projects"]
+            yield list(
+                self.filter_projects(
+                    _project_from_node(node) for node in projects["nodes"]
+                )
+            )
+            if not projects["pageInfo"]["hasNextPage"]:
+                break
+            after = projects["pageInfo"]["endCursor"]
+
+    async def iter_projects(self):
+        """Yield repositories under the configured paths as they are found."""
+        entities = {path.parts[0] for path in self.config.paths}
+        queue = asyncio.Queue()
+        seen = set()
+        async with gitlab_sync.api.api_session(self.config) as self.session:
+            put = self._put_entity_projects
+            if self.since is not None:
+                put = self._put_active_projects
+            producer = asyncio.ensure_future(
+                asyncio.gather(*[put(entity, queue) for entity in entities])
+            )
+            producer.add_done_callback(lambda _: queue.put_nowait(None))
+            try:
+                while True:
+                    repos = await queue.get()
+                    if repos is None:
+                        break
+                    for repo in repos:
+                        if repo.gitlab_project_id not in seen:
+                            seen.add(repo.gitlab_project_id)
+                            yield repo
+                # raise any error from collecting projects
+                await producer
+            finally:
+                producer.cancel()
+                if self.cache is not None:
+                    self.cache.evict()
 
     def collect_paths(self):
         """
         Return a list of Repository object for projects under the given paths in GitLab.
 
         """
+
+        async def collect():
+            return [repo async for repo in self.iter_projects()]
+
         loop = asyncio.get_event_loop()
-        return loop.run_until_complete(self._get_paths(self.config.paths))
+        return loop.run_until_complete(collect())
+
 
+async def enumerate_remote(config, since=None):
+    """Yield repositories available to the given access token as they are found.
 
-def enumerate_remote(config):
-    """Return all repositories available to the given access token."""
-    # TODO: return a generator which collects from asyncio
+    If since is given, only projects with activity since then are yielded.
+
+    """
     # TODO: think how this can work where users want to clone everything under their user/group
-    return ProjectCollector(config).collect_paths()
+    async for repo in ProjectCollector(config, since=since).iter_projects():
+        yield repo
+
+
+class SharedEnumeration(object):
+    """One enumeration of GitLab shared by local copies using the same token.
+
+    The projects under the paths of every copy are collected once, and each
+    copy is given those under its own paths. Settings for how GitLab is
+    enumerated are taken from the first copy. If since is given, only
+    projects active since then are collected.
+
+    """
+
+    def __init__(self, configs, since=None):
+        self.configs = configs
+        self.since = since
+        paths = []
+        for config in configs:
+            paths.extend(path for path in config.paths if path not in paths)
+        self.collector = ProjectCollector(
+            attr.evolve(
+                configs[0],
+                paths=paths,
+                project_statistics=any(config.project_statistics for config in configs),
+            ),
+            simple=all(config.object_pool is None for config in configs),
+            since=since,
+        )
+        self._queues = {config.base_path: asyncio.Queue() for config in configs}
+
+    async def run(self):
+        """Collect projects, passing errors on to the copies rather than raising."""
+        end = None
+        try:
+            async for repo in self.collector.iter_projects():
+                for config in self.configs:
+                    if in_paths(repo.gitlab_path, config.paths):
+                        self._queues[config.base_path].put_nowait(repo)
+        except BaseException as e:
+            # a listing stopped early, even by cancellation, isn't complete
+            end = e
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            for queue in self._queues.values():
+                queue.put_nowait(end)
+
+    async def remotes(self, config):
+        """Yield repositories for a copy as they are found, like enumerate_remote."""
+        queue = self._queues[config.base_path]
+        while True:
+            repo = await queue.get()
+            if repo is None:
+                break
+            if isinstance(repo, BaseException):
+                raise repo
+            yield repo
+
+
+def share_enumerations(configs, since=None):
+    """Return a SharedEnumeration for each GitLab and access token pair.
+
+    since maps base paths to when copies need projects listed since, or None
+    if they need every project listed. Copies sharing an enumeration only get
+    projects listed since a time if all of them can.
+
+    """
+    since = since or {}
+    groups = collections.OrderedDict()
+    for config in configs:
+        key = (config.gitlab_http, config.access_token)
+        groups.setdefault(key, []).append(config)
+    enumerations = []
+    for group in groups.values():
+        times = [since.get(config.base_path) for config in group]
+        enumerations.append(
+            SharedEnumeration(group, None if None in times else min(times))
+        )
+    return enumerations
@@ -0,0 +1,111 @@
+"""Module for sharing SSH connections between git commands.
+
+Each git command which talks to GitLab over SSH would otherwise make its own
+connection, and for small repositories the handshakes take longer than the
+transfers. While a Multiplexer is in use, git runs ssh with ControlMaster
+sockets in a private directory, so commands are multiplexed over a few master
+connections to each host.
+
+The ssh command git would have run, from GIT_SSH_COMMAND, core.sshCommand, or
+GIT_SSH, is kept, with the options for sharing connections added to it, as
+long as it is OpenSSH.
+
+"""
+import asyncio
+import itertools
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+
+from gitlab_sync import logger
+
+# seconds masters are kept open without any commands using them
+_PERSIST = 60
+
+
+def uses_ssh(gitlab_git):
+    """Return True if git talks to GitLab over SSH at the given URL."""
+    return gitlab_git.startswith("ssh://") or "://" not in gitlab_git
+
+
+def ssh_command(directory=None):
+    """Return the command git runs ssh with, in the form of GIT_SSH_COMMAND.
+
+    This is looked up in the order git uses, with core.sshCommand read from
+    outside any repository, from the given directory.
+
+    """
+    command = os.environ.get("GIT_SSH_COMMAND")
+    if command:
+        return command
+    result = subprocess.run(
+        ["git", "config", "--get", "core.sshCommand"],
+        cwd=directory,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        universal_newlines=True,
+    )
+    if result.stdout.strip():
+        return result.stdout.strip()
+    ssh = os.environ.get("GIT_SSH")
+    if ssh:
+        return shlex.quote(ssh)
+    return "ssh"
+
+
+class Multiplexer(object):
+    """Spreads git commands across a number of SSH master connections.
+
+    Each master carries up to sessions commands at once, and sessions is a
+    semaphore for that many commands across all of them.
+
+    """
+
+    def __init__(self, masters, sessions=10):
+        self.masters = masters
+        self.sessions = asyncio.Semaphore(masters * sessions)
+        # mkdtemp makes a directory only the current user can use
+        self.directory = tempfile.mkdtemp(prefix="gitlab-sync-ssh-")
+        self.ssh = ssh_command(self.directory)
+        program = os.path.basename(shlex.split(self.ssh)[0])
+        # other programs, like plink, don't take OpenSSH's options
+        self.enabled = os.path.splitext(program)[0] == "ssh"
+        self._slots = itertools.cycle(range(masters))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def environment(self):
+        """Return the environment to run a git command with, or None for this one."""
+        if not self.enabled:
+            return None
+        control_path = os.path.join(self.directory, "%C-{}".format(next(self._slots)))
+        environment = dict(os.environ)
+        environment["GIT_SSH_COMMAND"] = " ".join(
+            [
+                self.ssh,
+                "-o ControlMaster=auto",
+                "-o",
+                shlex.quote("ControlPath=" + control_path),
+                "-o ControlPersist=%d" % _PERSIST,
+            ]
+        )
+        return environment
+
+    def close(self):
+        """Stop the master connections, and remove their sockets."""
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            logger.debug("closing SSH master connection %s", path)
+            # the host is ignored when connecting through a control socket
+            subprocess.run(
+                ["ssh", "-o", "ControlPath=" + path, "-O", "exit", "gitlab-sync"],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        shutil.rmtree(self.directory, ignore_errors=True)
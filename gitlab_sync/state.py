@@ -0,0 +1,256 @@
+"""Module for the index of state kept alongside each local copy.
+
+The index saves reading the gitlab-sync.* git config of every repository on
+every run, and records details of when and what each repository was last
+synchronised to. Git config remains the source of truth, so the index can
+always be rebuilt from the repositories if it is missing or corrupt.
+
+"""
+import json
+import pathlib
+import sqlite3
+import time
+import typing
+
+import attr
+from gitlab_sync import logger
+
+STATE_DIRECTORY = ".gitlab-sync"
+
+# each statement upgrades the schema by one version, so new columns can be
+# added without throwing away what is already known
+_MIGRATIONS = [
+    """
+    CREATE TABLE repositories (
+        relative_path TEXT PRIMARY KEY,
+        project_id INTEGER NOT NULL,
+        gitlab_path TEXT,
+        refs TEXT,
+        cloned_at REAL,
+        fetched_at REAL
+    )
+    """,
+    "ALTER TABLE repositories ADD COLUMN last_activity_at TEXT",
+    "ALTER TABLE repositories ADD COLUMN maintained_at REAL",
+    "ALTER TABLE repositories ADD COLUMN repacked_at REAL",
+    "ALTER TABLE repositories ADD COLUMN head TEXT",
+    """
+    CREATE TABLE journal (
+        relative_path TEXT PRIMARY KEY,
+        operation TEXT NOT NULL,
+        project_id INTEGER,
+        target TEXT,
+        started_at REAL
+    )
+    """,
+    "CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)",
+    "ALTER TABLE repositories ADD COLUMN transfer_seconds REAL",
+    "ALTER TABLE repositories ADD COLUMN trimming TEXT",
+]
+
+
+@attr.s(auto_attribs=True)
+class IndexEntry:
+    relative_path: pathlib.Path
+    project_id: int
+    gitlab_path: typing.Optional[pathlib.Path] = None
+    refs: typing.Dict[str, str] = attr.Factory(dict)
+    cloned_at: typing.Optional[float] = None
+    fetched_at: typing.Optional[float] = None
+    last_activity_at: typing.Optional[str] = None
+    maintained_at: typing.Optional[float] = None
+    repacked_at: typing.Optional[float] = None
+    head: typing.Optional[str] = None
+    # how long the last copy, update, or download which transferred took
+    transfer_seconds: typing.Optional[float] = None
+    # the settings which trimmed what was fetched and checked out, if any
+    trimming: typing.Optional[str] = None
+
+    @classmethod
+    def from_row(cls, row):
+        values = dict(row)
+        values["relative_path"] = pathlib.Path(values["relative_path"])
+        if values["gitlab_path"] is not None:
+            values["gitlab_path"] = pathlib.Path(values["gitlab_path"])
+        values["refs"] = json.loads(values["refs"] or "{}")
+        return cls(**values)
+
+
+@attr.s(auto_attribs=True)
+class JournalEntry:
+    relative_path: pathlib.Path
+    operation: str
+    project_id: typing.Optional[int] = None
+    target: typing.Optional[pathlib.Path] = None
+    started_at: typing.Optional[float] = None
+
+    @classmethod
+    def from_row(cls, row):
+        values = dict(row)
+        values["relative_path"] = pathlib.Path(values["relative_path"])
+        if values["target"] is not None:
+            values["target"] = pathlib.Path(values["target"])
+        return cls(**values)
+
+
+class StateIndex(object):
+    """SQLite backed index of the repositories under a base path.
+
+    Every change is made in its own transaction, so the index is consistent
+    with the operations which have completed if a run is interrupted.
+
+    """
+
+    def __init__(self, base_path):
+        self.path = base_path / STATE_DIRECTORY / "state.sqlite"
+        self.path.parent.mkdir(exist_ok=True)
+        try:
+            self.connection = self._connect()
+        except sqlite3.DatabaseError as e:
+            logger.warning("rebuilding corrupt state index %s: %s", self.path, e)
+            for suffix in ("", "-wal", "-shm"):
+                path = self.path.with_name(self.path.name + suffix)
+                if path.exists():
+                    path.unlink()
+            self.connection = self._connect()
+
+    def _connect(self):
+        connection = sqlite3.connect(str(self.path))
+        try:
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            if version > len(_MIGRATIONS):
+                raise sqlite3.DatabaseError("unknown schema version %d" % version)
+            with connection:
+                for statement in _MIGRATIONS[version:]:
+                    connection.execute(statement)
+                connection.execute("PRAGMA user_version=%d" % len(_MIGRATIONS))
+            # make sure the table is readable before trusting it
+            connection.execute("SELECT * FROM repositories LIMIT 1").fetchall()
+        except sqlite3.DatabaseError:
+            connection.close()
+            raise
+        return connection
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def entries(self) -> typing.Dict[pathlib.Path, IndexEntry]:
+        """Return all entries keyed by their path relative to the base path."""
+        rows = self.connection.execute("SELECT * FROM repositories")
+        return {entry.relative_path: entry for entry in map(IndexEntry.from_row, rows)}
+
+    def add(self, repo):
+        """Add or replace the entry for a local repository, keeping sync details."""
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO repositories (relative_path, project_id)"
+                " VALUES (?, ?)",
+                (str(repo.relative_path), repo.gitlab_project_id),
+            )
+            self.connection.execute(
+                "UPDATE repositories SET project_id = ?, gitlab_path = ?"
+                " WHERE relative_path = ?",
+                (
+                    repo.gitlab_project_id,
+                    _optional_str(repo.gitlab_path),
+                    str(repo.relative_path),
+                ),
+            )
+
+    def update(self, repo, **values):
+        """Set values on the entry for a local repository, adding it if needed."""
+        if "refs" in values:
+            values["refs"] = json.dumps(values["refs"], sort_keys=True)
+        self.add(repo)
+        if values:
+            with self.connection:
+                self.connection.execute(
+                    "UPDATE repositories SET %s WHERE relative_path = ?"
+                    % ", ".join("%s = ?" % column for column in values),
+                    list(values.values()) + [str(repo.relative_path)],
+                )
+
+    def move(self, old, new):
+        """Move the entry for a repository which has moved locally."""
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM repositories WHERE relative_path = ?",
+                (str(new.relative_path),),
+            )
+            self.connection.execute(
+                "UPDATE repositories SET relative_path = ?, gitlab_path = ?"
+                " WHERE relative_path = ?",
+                (
+                    str(new.relative_path),
+                    _optional_str(new.gitlab_path),
+                    str(old.relative_path),
+                ),
+            )
+
+    def begin(self, operation, relative_path, project_id, target=None):
+        """Record that an operation on a repository has started.
+
+        Operations are recorded in a journal until they finish, so a run
+        can find and deal with operations an interrupted run left part done.
+
+        """
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO journal"
+                " (relative_path, operation, project_id, target, started_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (
+                    str(relative_path),
+                    operation,
+                    project_id,
+                    _optional_str(target),
+                    time.time(),
+                ),
+            )
+
+    def finish(self, relative_path):
+        """Record that the operation on a repository has finished."""
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM journal WHERE relative_path = ?", (str(relative_path),)
+            )
+
+    def journal(self) -> typing.List[JournalEntry]:
+        """Return the operations which have been started but not finished."""
+        rows = self.connection.execute("SELECT * FROM journal ORDER BY started_at")
+        return [JournalEntry.from_row(row) for row in rows]
+
+    def get_value(self, key):
+        """Return a value saved about the copy as a whole, or None."""
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return None if row is None else json.loads(row["value"])
+
+    def set_value(self, key, value):
+        """Save a JSON serialisable value about the copy as a whole."""
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                (key, json.dumps(value)),
+            )
+
+    def remove(self, relative_paths):
+        """Remove the entries for the given relative paths."""
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM repositories WHERE relative_path = ?",
+                [(str(path),) for path in relative_paths],
+            )
+
+
+def _optional_str(value):
+    return None if value is None else str(value)
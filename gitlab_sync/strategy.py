@@ -5,19 +5,103 @@ little if/else handling as possible, with lower level methods having 0
 knowledge of their use.
 
 """
-import shutil
+import asyncio
+import collections
+import functools
+import heapq
+import itertools
+import json
+import time
 
+import gitlab_sync
+import gitlab_sync.api
+import gitlab_sync.metrics
 import gitlab_sync.operations
 import gitlab_sync.repository
-from gitlab_sync import logger
+import gitlab_sync.ssh
+import gitlab_sync.state
+from gitlab_sync import SyncError, logger
+
+# names of the functions which can be the strategy of a local copy
+STRATEGIES = ("mirror", "snapshot")
+# how long GitLab can go without updating a project's last_activity_at
+_ACTIVITY_INTERVAL = 60 * 60
+# when git maintenance would pack loose objects, and combine packs
+_LOOSE_OBJECTS = 100
+_PACKS = 10
+# bytes a second to guess transfers of repositories of known size go at
+_TRANSFER_RATE = 10 * 1024 * 1024
 
 
 # XXX: it may be good to generate the maps in a helper method
-def mirror(config):
-    """Perform necissary actions to update a local copy using backup logic."""
-    locals_ = list(gitlab_sync.repository.enumerate_local(config.base_path))
-    # TODO: update paths to be namespaces in other places
-    remotes = list(gitlab_sync.repository.enumerate_remote(config))
+async def mirror(config, remotes=None, since=None):
+    """Perform necissary actions to update a local copy using backup logic.
+
+    Copies and updates start while GitLab is still being enumerated, unless
+    they could be affected by a delete or move, which only happen once all
+    remote repositories are known. Remote repositories are enumerated from
+    GitLab unless an async iterable of them is given, along with since if it
+    only holds projects active since then, in which case nothing is deleted.
+
+    With ref_check set to use the API, which it is by default for copies of
+    single branches, the default branch heads of projects are looked up from
+    GitLab in batches rather than one ls-remote per repository.
+
+    """
+    with gitlab_sync.state.StateIndex(config.base_path) as index:
+        if remotes is None:
+            since = delta_since(config, index)
+            remotes = gitlab_sync.repository.enumerate_remote(config, since)
+        if config.ref_check == "api" or (
+            config.ref_check == "auto" and config.single_branch
+        ):
+            async with gitlab_sync.api.api_session(config) as session:
+                heads = gitlab_sync.repository.HeadLoader(config, session)
+                await _mirror(config, index, remotes, heads, since)
+        else:
+            await _mirror(config, index, remotes, since=since)
+
+
+def delta_since(config, index=None):
+    """Return when a copy needs projects listed since, or None for every project.
+
+    With delta_listing, only projects active since the last listing need
+    listing, going back far enough for GitLab's hourly updates of activity
+    times, as long as every project under the same paths has been listed in
+    the last full_listing_interval hours. Deletes, and moves without other
+    activity, are only noticed by listings of every project.
+
+    """
+    if not config.delta_listing:
+        return None
+    if index is None:
+        with gitlab_sync.state.StateIndex(config.base_path) as index:
+            return delta_since(config, index)
+    listing = index.get_value("listing")
+    if (
+        listing is None
+        or listing["paths"] != sorted(str(path) for path in config.paths)
+        or time.time() - listing["full"] >= config.full_listing_interval * 60 * 60
+    ):
+        return None
+    return listing["last"] - _ACTIVITY_INTERVAL
+
+
+def _listed(config, index, started, since):
+    """Record a listing which every change has been synchronised from."""
+    listing = index.get_value("listing")
+    if since is None:
+        listing = {"full": started, "paths": sorted(str(path) for path in config.paths)}
+    listing["last"] = started
+    index.set_value("listing", listing)
+
+
+async def _mirror(config, index, remotes, heads=None, since=None):
+    started = time.time()
+    with gitlab_sync.metrics.timed("phase", "recover", config.base_path):
+        resumed = await _recover(config, index)
+    with gitlab_sync.metrics.timed("phase", "enumerate_local", config.base_path):
+        locals_ = list(gitlab_sync.repository.enumerate_local(config.base_path, index))
 
     remoteless = [repo for repo in locals_ if repo.gitlab_project_id is None]
     if remoteless:
@@ -25,53 +109,713 @@ def mirror(config):
         # low chance of being due to a failure between git-init and git-config
         raise Exception("Unexpected directories.")
     local_map = {repo.gitlab_project_id: repo for repo in locals_}
-    remote_map = {repo.gitlab_project_id: repo for repo in remotes}
+    entries = index.entries()
     logger.debug("local repos found: %r", locals_)
-    logger.debug("remote repos found: %r", remotes)
-
-    delete_map = {}
-    for id_ in local_map.keys() - remote_map.keys():
-        repo = local_map.pop(id_)
-        delete_map[repo.gitlab_project_id] = repo
-
-    create_map = {}
-    for id_ in remote_map.keys() - local_map.keys():
-        repo = remote_map.pop(id_)
-        create_map[repo.gitlab_project_id] = repo
+    # copies in or around these paths have to wait for deletes and moves
+    occupied = {repo.relative_path for repo in locals_}
 
+    scheduler = _Scheduler(
+        config.workers, config.namespace_workers, _ssh_sessions(config)
+    )
+    deferred = []
+    remote_map = {}
     move_map = {}
-    for id_, local in local_map.items():
-        remote = remote_map[id_]
-        if local.gitlab_path and remote.gitlab_path != local.gitlab_path:
-            move_map[id_] = (remote, local.gitlab_path, remote.gitlab_path)
-
-    update_map = {
-        id_: gitlab_sync.repository.LocalRepository.from_remote(config, remote)
-        for id_, remote in remote_map.items()
-        if id_ not in create_map
-    }
+    unchanged = 0
+    try:
+        # TODO: update paths to be namespaces in other places
+        with gitlab_sync.metrics.timed("phase", "enumerate_remote", config.base_path):
+            async for remote in remotes:
+                id_ = remote.gitlab_project_id
+                remote_map[id_] = remote
+                local = local_map.get(id_)
+                if local is None:
+                    local = gitlab_sync.repository.LocalRepository.from_remote(
+                        config, remote
+                    )
+                    job = (
+                        "copied",
+                        local,
+                        functools.partial(_copy, config, index, local, remote),
+                        _estimate(None, remote),
+                        remote.gitlab_path.parent,
+                    )
+                    if gitlab_sync.repository.overlaps(local.relative_path, occupied):
+                        deferred.append(job)
+                    else:
+                        scheduler.start(*job)
+                    continue
+                repo = gitlab_sync.repository.LocalRepository.from_remote(
+                    config, remote
+                )
+                # interrupted updates are redone, whatever the index says
+                entry = known = entries.get(local.relative_path)
+                if local.relative_path in resumed:
+                    entry = None
+                moved = local.gitlab_path and remote.gitlab_path != local.gitlab_path
+                if (
+                    not moved
+                    and config.incremental
+                    and _unchanged(entry, remote)
+                    and entry.trimming == _trimming(config)
+                ):
+                    logger.debug("%s has had no activity since it was updated", repo)
+                    unchanged += 1
+                    continue
+                api_head = None
+                if heads is not None and _checks_refs(config, entry):
+                    api_head = heads.load(id_)
+                job = (
+                    "updated",
+                    repo,
+                    functools.partial(
+                        _update, config, index, repo, remote, entry, api_head
+                    ),
+                    _estimate(known, remote),
+                    remote.gitlab_path.parent,
+                )
+                if moved:
+                    move_map[id_] = (local, repo, remote)
+                    deferred.append(job)
+                else:
+                    scheduler.start(*job)
+    except Exception:
+        # let started jobs finish rather than leaving half done copies
+        if scheduler.jobs:
+            await asyncio.wait([task for _, _, task in scheduler.jobs])
+        raise
+    logger.debug("remote repos found: %r", list(remote_map.values()))
 
+    delete_map = {}
+    if since is None:
+        delete_map = {
+            id_: repo for id_, repo in local_map.items() if id_ not in remote_map
+        }
     for repo in sorted(delete_map.values()):
         logger.info("deleting %s", repo)
-        gitlab_sync.operations.delete_local(repo)
+        index.begin("delete", repo.relative_path, repo.gitlab_project_id)
+        with gitlab_sync.metrics.timed("operation", "deleted", config.base_path):
+            await _delete(config, index, repo)
         # TODO: think about being definsive against errors reading from GitLab
         # maybe GitLab retains projects in the database after they are deleted?
         # tombstones would be nice
 
-    for repo, old_gitlab_path, new_gitlab_path in sorted(move_map.values()):
-        logger.info("moving %s to %s", old_gitlab_path, new_gitlab_path)
-        shutil.move(
-            str(config.base_path / old_gitlab_path),
-            str(config.base_path / new_gitlab_path),
+    for old, new, remote in sorted(move_map.values()):
+        await _move(config, index, old, new, remote)
+
+    for job in deferred:
+        scheduler.start(*job)
+    try:
+        with gitlab_sync.metrics.timed("phase", "transfer", config.base_path):
+            await _finish_jobs(config, scheduler.jobs, unchanged)
+        _listed(config, index, started, since)
+    finally:
+        await _maintain(config, index)
+
+
+async def sync_projects(config, project_ids):
+    """Synchronise only the given projects of a local copy, as mirror would.
+
+    This is for when GitLab says which projects have changed. Each project is
+    looked up on GitLab, and copied, moved, updated, or deleted if it is gone
+    or no longer under the configured paths. Returns True if any projects
+    would go in or around the path of another repository, which only a full
+    mirror run can sort out.
+
+    """
+    with gitlab_sync.state.StateIndex(config.base_path) as index:
+        resumed = await _recover(config, index)
+        entries = {entry.project_id: entry for entry in index.entries().values()}
+        scheduler = _Scheduler(
+            config.workers, config.namespace_workers, _ssh_sessions(config)
+        )
+        conflicted = False
+        async with gitlab_sync.api.api_session(config) as session:
+            remotes = await asyncio.gather(
+                *[
+                    gitlab_sync.repository.get_project(session, config, id_)
+                    for id_ in project_ids
+                ]
+            )
+            for id_, remote in zip(project_ids, remotes):
+                entry = entries.get(id_)
+                local = None
+                if entry is not None:
+                    local = gitlab_sync.repository.LocalRepository.from_entry(
+                        config.base_path, entry
+                    )
+                if remote is None or not gitlab_sync.repository.in_paths(
+                    remote.gitlab_path, config.paths
+                ):
+                    if local is not None:
+                        logger.info("deleting %s", local)
+                        index.begin("delete", local.relative_path, id_)
+                        with gitlab_sync.metrics.timed(
+                            "operation", "deleted", config.base_path
+                        ):
+                            await _delete(config, index, local)
+                    continue
+                repo = gitlab_sync.repository.LocalRepository.from_remote(
+                    config, remote
+                )
+                if local is None or local.relative_path != repo.relative_path:
+                    others = {
+                        other.relative_path
+                        for other in entries.values()
+                        if other is not entry
+                    }
+                    if gitlab_sync.repository.overlaps(repo.relative_path, others):
+                        logger.info("%s is in the way of %s", repo, remote)
+                        conflicted = True
+                        continue
+                namespace = remote.gitlab_path.parent
+                if local is None:
+                    job = functools.partial(_copy, config, index, repo, remote)
+                    scheduler.start(
+                        "copied", repo, job, _estimate(None, remote), namespace
+                    )
+                    continue
+                if local.relative_path != repo.relative_path:
+                    await _move(config, index, local, repo, remote)
+                cost = _estimate(entry, remote)
+                if local.relative_path in resumed:
+                    entry = None
+                job = functools.partial(_update, config, index, repo, remote, entry)
+                scheduler.start("updated", repo, job, cost, namespace)
+            await _finish_jobs(config, scheduler.jobs)
+    return conflicted
+
+
+async def snapshot(config, remotes=None, since=None):
+    """Keep an extracted archive of the default branch of each project.
+
+    Snapshots aren't git repositories, and are only downloaded again when the
+    head of the default branch changes, which suits copies that are only
+    searched. Deletes and moves happen once all remote repositories are known,
+    before any downloads. Remote repositories are given as for mirror.
+
+    """
+    with gitlab_sync.state.StateIndex(config.base_path) as index:
+        if remotes is None:
+            since = delta_since(config, index)
+            remotes = gitlab_sync.repository.enumerate_remote(config, since)
+        async with gitlab_sync.api.api_session(config) as session:
+            await _snapshot(config, index, session, remotes, since)
+
+
+async def _snapshot(config, index, session, remotes, since=None):
+    started = time.time()
+    with gitlab_sync.metrics.timed("phase", "enumerate_local", config.base_path):
+        locals_ = list(
+            gitlab_sync.repository.enumerate_snapshots(config.base_path, index)
+        )
+    local_map = {repo.gitlab_project_id: repo for repo in locals_}
+    entries = index.entries()
+    remote_map = collections.OrderedDict()
+    with gitlab_sync.metrics.timed("phase", "enumerate_remote", config.base_path):
+        async for remote in remotes:
+            remote_map[remote.gitlab_project_id] = remote
+
+    loop = asyncio.get_event_loop()
+    for id_, repo in sorted(local_map.items(), key=lambda item: item[1]):
+        if since is None and id_ not in remote_map:
+            logger.info("deleting %s", repo)
+            with gitlab_sync.metrics.timed("operation", "deleted", config.base_path):
+                await loop.run_in_executor(
+                    None, gitlab_sync.operations.delete_local, repo
+                )
+            index.remove([repo.relative_path])
+
+    scheduler = _Scheduler(config.workers, config.namespace_workers)
+    unchanged = 0
+    for id_, remote in remote_map.items():
+        repo = gitlab_sync.repository.LocalRepository.from_remote(config, remote)
+        local = local_map.get(id_)
+        entry = None
+        if local is not None:
+            entry = entries.get(local.relative_path)
+            if remote.gitlab_path != local.gitlab_path:
+                logger.info("moving %s to %s", local.gitlab_path, remote.gitlab_path)
+                with gitlab_sync.metrics.timed("operation", "moved", config.base_path):
+                    await gitlab_sync.operations.move_snapshot(local, repo, remote)
+                index.move(local, repo)
+            if config.incremental and _unchanged(entry, remote):
+                logger.debug("%s has had no activity since it was updated", repo)
+                unchanged += 1
+                continue
+        job = functools.partial(_download, config, index, session, repo, remote, entry)
+        scheduler.start(
+            "copied" if local is None else "updated",
+            repo,
+            job,
+            _estimate(entry, remote),
+            remote.gitlab_path.parent,
+        )
+    with gitlab_sync.metrics.timed("phase", "transfer", config.base_path):
+        await _finish_jobs(config, scheduler.jobs, unchanged)
+    _listed(config, index, started, since)
+
+
+async def _download(config, index, session, repo, remote, entry):
+    """Download a snapshot if the head of its default branch has changed."""
+    started = time.time()
+    commit = await gitlab_sync.operations.snapshot_head(session, config, remote)
+    values = {"fetched_at": started, "last_activity_at": remote.last_activity_at}
+    if entry is not None and entry.refs.get("HEAD") == commit:
+        logger.debug("%s is already a snapshot of %s", repo, commit)
+        index.update(repo, **values)
+        return "unchanged"
+    logger.info("downloading %s", remote)
+    await gitlab_sync.operations.download_snapshot(
+        session, config, repo, remote, commit
+    )
+    if entry is None:
+        values["cloned_at"] = started
+    values["transfer_seconds"] = time.time() - started
+    index.update(repo, refs={"HEAD": commit}, **values)
+
+
+async def _recover(config, index):
+    """Finish or roll back operations left part done by an interrupted run.
+
+    Part done clones are removed, to be copied again, and deletes and moves
+    are finished where they got far enough, or otherwise left to be planned
+    again. Returns the relative paths of repositories whose update was
+    interrupted, which are updated again whatever the index says.
+
+    """
+    resumed = set()
+    for entry in index.journal():
+        repo = gitlab_sync.repository.LocalRepository(
+            config.base_path, entry.relative_path
+        )
+        repo._gitlab_project_id = entry.project_id
+        if entry.operation == "update":
+            resumed.add(entry.relative_path)
+            continue
+        if entry.operation == "clone":
+            logger.warning("removing the interrupted copy of %s", entry.relative_path)
+            await _delete(config, index, repo)
+        elif entry.operation == "delete":
+            logger.warning("finishing the deletion of %s", entry.relative_path)
+            await _delete(config, index, repo)
+        elif entry.operation == "move":
+            remote = gitlab_sync.repository.GitlabRepository(
+                entry.target, entry.project_id
+            )
+            new = gitlab_sync.repository.LocalRepository.from_remote(config, remote)
+            if new.absolute_path.exists() and not repo.absolute_path.exists():
+                logger.warning("finishing the move of %s to %s", repo, remote)
+                await gitlab_sync.operations.finish_move(config, new, remote)
+                index.move(repo, new)
+        index.finish(entry.relative_path)
+    return resumed
+
+
+async def _move(config, index, old, new, remote):
+    logger.info("moving %s to %s", old.gitlab_path, remote.gitlab_path)
+    index.begin("move", old.relative_path, remote.gitlab_project_id, remote.gitlab_path)
+    with gitlab_sync.metrics.timed("operation", "moved", config.base_path):
+        await gitlab_sync.operations.move(config, old, new, remote)
+    index.move(old, new)
+    index.finish(old.relative_path)
+
+
+async def _delete(config, index, repo):
+    if repo.absolute_path.exists():
+        if config.object_pool:
+            pool = gitlab_sync.operations.joined_pool(config, repo)
+            if pool:
+                # let the pool prune objects only this repository used
+                await gitlab_sync.operations.leave_pool(repo, pool)
+        await asyncio.get_event_loop().run_in_executor(
+            None, gitlab_sync.operations.delete_local, repo
+        )
+    index.remove([repo.relative_path])
+    index.finish(repo.relative_path)
+
+
+def _unchanged(entry, remote):
+    """Return True if a project has had no activity since its last update.
+
+    GitLab only updates last_activity_at if it is over an hour old, so the
+    value is only trusted if the last fetch was over an hour after it.
+
+    """
+    if entry is None or entry.fetched_at is None or not remote.last_activity_at:
+        return False
+    if entry.last_activity_at != remote.last_activity_at:
+        return False
+    last_activity = gitlab_sync.repository.parse_time(remote.last_activity_at)
+    return entry.fetched_at >= last_activity + _ACTIVITY_INTERVAL
+
+
+async def _copy(config, index, local, remote):
+    logger.info("copying %s", remote)
+    started = time.time()
+    index.begin("clone", local.relative_path, remote.gitlab_project_id)
+    pool = None
+    if config.object_pool:
+        pool = gitlab_sync.operations.object_pool(config, remote)
+    head = await gitlab_sync.operations.clone(config, local, remote, pool)
+    if pool:
+        await gitlab_sync.operations.share_objects(local, pool)
+        await gitlab_sync.operations.drop_pooled_objects(local)
+    index.update(
+        local,
+        refs=await local.remote_refs(),
+        head=head,
+        cloned_at=started,
+        fetched_at=started,
+        last_activity_at=remote.last_activity_at,
+        transfer_seconds=time.time() - started,
+        trimming=_trimming(config),
+    )
+    index.finish(local.relative_path)
+
+
+def _trimming(config):
+    """Return the settings trimming what a copy fetches and checks out, or None.
+
+    These are kept with each repository, which is updated whatever its refs
+    if they change, as updates are what apply them.
+
+    """
+    trimming = {
+        name: getattr(config, name)
+        for name in ("single_branch", "depth", "filter", "sparse_checkout")
+        if getattr(config, name)
+    }
+    return json.dumps(trimming, sort_keys=True) if trimming else None
+
+
+async def _check_refs(config, repo, remote, entry, api_head=None):
+    """Return the branch the remote HEAD is on, and if no refs have changed.
+
+    The default branch and its head from the API are used if a future for
+    them is given, and GitLab knew them. Otherwise the refs in the entry for
+    the repository are compared against the ref advertisement of the remote.
+
+    """
+    known = None
+    if api_head is not None:
+        try:
+            known = await api_head
+        except Exception as e:
+            logger.debug("couldn't get the head of %s from GitLab: %s", repo, e)
+    if known is not None:
+        head, commit = known
+        ref = "refs/remotes/origin/" + head
+        return head, head == entry.head and entry.refs.get(ref) == commit
+    head, refs = await gitlab_sync.operations.remote_heads(config, repo, remote)
+    stored = {
+        ref: commit
+        for ref, commit in entry.refs.items()
+        if ref != "refs/remotes/origin/HEAD"
+        and (ref in refs or not config.single_branch)
+    }
+    return head, head == entry.head and refs == stored
+
+
+def _checks_refs(config, entry):
+    """Return if an update compares refs before fetching anything."""
+    return (
+        entry is not None
+        and entry.fetched_at is not None
+        and entry.trimming == _trimming(config)
+        and config.ref_check != "none"
+    )
+
+
+async def _update(config, index, repo, remote, entry=None, api_head=None):
+    """Update a repository, unless its refs match those on the remote.
+
+    Checking the refs first saves fetching, checking out, and cleaning when
+    nothing has changed.
+
+    """
+    started = time.time()
+    values = {"fetched_at": started, "last_activity_at": remote.last_activity_at}
+    head = None
+    if _checks_refs(config, entry):
+        head, unchanged = await _check_refs(config, repo, remote, entry, api_head)
+        if unchanged:
+            logger.debug("%s has the same refs as the remote", repo)
+            # nothing was fetched, so maintenance which was current still is
+            if (entry.maintained_at or 0) >= entry.fetched_at:
+                values["maintained_at"] = started
+            index.update(repo, **values)
+            return "unchanged"
+    logger.info("updating %s", repo)
+    index.begin("update", repo.relative_path, remote.gitlab_project_id)
+    pool = None
+    joined = False
+    if config.object_pool:
+        pool = gitlab_sync.operations.joined_pool(config, repo)
+        if pool is None:
+            pool = gitlab_sync.operations.object_pool(config, remote)
+            if pool:
+                await gitlab_sync.operations.join_pool(repo, pool)
+                joined = True
+    head = await gitlab_sync.operations.update_local(config, repo, remote, head)
+    if pool:
+        await gitlab_sync.operations.share_objects(repo, pool)
+    if joined:
+        await gitlab_sync.operations.drop_pooled_objects(repo)
+    values["transfer_seconds"] = time.time() - started
+    values["trimming"] = _trimming(config)
+    index.update(repo, refs=await repo.remote_refs(), head=head, **values)
+    index.finish(repo.relative_path)
+
+
+def _maintenance_plan(config, entries, now):
+    """Return (task, repo) pairs for repositories which need maintenance.
+
+    Repositories are repacked every repack_interval days, oldest first, and
+    otherwise have the cheap tasks run when they have been fetched into since
+    their last maintenance, or have too many loose objects or packs. Those
+    come first, as the ones most in need of them. Repositories in object
+    pools are always repacked when due, which drops objects they fetched
+    that are in their pool, and the pools themselves come last.
+
+    """
+    maintain = []
+    repack = []
+    pools = {}
+    for entry in entries.values():
+        repo = gitlab_sync.repository.LocalRepository.from_entry(
+            config.base_path, entry
         )
+        pool = None
+        if config.object_pool:
+            pool = gitlab_sync.operations.joined_pool(config, repo)
+        if pool is not None:
+            pools[pool.absolute_path] = pool
+        loose, packs = gitlab_sync.operations.object_counts(repo)
+        repacked_at = entry.repacked_at or entry.cloned_at or 0
+        if now - repacked_at >= config.repack_interval * 24 * 60 * 60 and (
+            loose or packs > 1 or pool is not None
+        ):
+            repack.append((repacked_at, repo))
+        elif (
+            loose >= _LOOSE_OBJECTS
+            or packs >= _PACKS
+            or (entry.fetched_at or 0) > (entry.maintained_at or 0)
+        ):
+            need = loose / _LOOSE_OBJECTS + packs / _PACKS
+            maintain.append((-need, repo))
+    maintain.sort(key=lambda item: item[0])
+    repack.sort(key=lambda item: item[0])
+    plan = [(gitlab_sync.operations.maintain, repo) for _, repo in maintain]
+    plan += [(gitlab_sync.operations.repack, repo) for _, repo in repack]
+    for path, pool in sorted(pools.items()):
+        loose, packs = gitlab_sync.operations.object_counts(pool)
+        if loose >= _LOOSE_OBJECTS or packs > 1:
+            plan.append((gitlab_sync.operations.maintain_pool, pool))
+    return plan
+
+
+async def _maintain(config, index):
+    """Maintain repositories until the maintenance budget is spent.
+
+    Maintenance which doesn't start within the budget waits for a later run,
+    which spreads full repacks of many repositories across runs.
 
-    for remote in sorted(create_map.values()):
-        logger.info("copying %s", remote)
-        local = gitlab_sync.repository.LocalRepository.from_remote(config, remote)
-        gitlab_sync.operations.clone(config, local, remote)
+    """
+    if not config.maintenance_budget:
+        return
+    deadline = time.monotonic() + config.maintenance_budget
+    plan = _maintenance_plan(config, index.entries(), time.time())
+    semaphore = asyncio.Semaphore(config.workers)
+    counts = collections.Counter()
 
-    for repo in sorted(update_map.values()):
-        logger.info("updating %s", repo)
-        gitlab_sync.operations.update_local(repo)
-        logger.info("cleaning %s", repo)
-        gitlab_sync.operations.clean(repo)
+    async def run(task, repo):
+        async with semaphore:
+            if time.monotonic() >= deadline:
+                counts["deferred"] += 1
+                return
+            started = time.time()
+            name = task.__name__ + "ed"
+            if task is gitlab_sync.operations.maintain_pool:
+                name = "pool_maintained"
+            try:
+                with gitlab_sync.metrics.timed("operation", name, config.base_path):
+                    await task(repo)
+            except Exception as e:
+                logger.warning("failed to maintain %s: %s", repo, e)
+                counts["failed"] += 1
+                return
+            counts[task.__name__] += 1
+            if task is gitlab_sync.operations.maintain_pool:
+                # pools are shared, so aren't in the index of any one copy
+                return
+            values = {"maintained_at": started}
+            if task is gitlab_sync.operations.repack:
+                values["repacked_at"] = started
+            index.update(repo, **values)
+
+    if plan:
+        with gitlab_sync.metrics.timed("phase", "maintain", config.base_path):
+            await asyncio.wait([asyncio.ensure_future(run(*item)) for item in plan])
+    logger.info(
+        "%s: maintained %d, repacked %d, pools %d, deferred %d, failed %d",
+        config.base_path,
+        counts["maintain"],
+        counts["repack"],
+        counts["maintain_pool"],
+        counts["deferred"],
+        counts["failed"],
+    )
+
+
+def _ssh_sessions(config):
+    """Return the semaphore for shared SSH sessions a copy uses, or None.
+
+    When SSH connections are shared, more git commands at once than the
+    masters have sessions for, whichever copies they are for, would have to
+    make connections of their own.
+
+    """
+    multiplexer = gitlab_sync.ssh_multiplexer
+    if multiplexer is None or not gitlab_sync.ssh.uses_ssh(config.gitlab_git):
+        return None
+    return multiplexer.sessions
+
+
+def _estimate(entry, remote):
+    """Return roughly how many seconds transferring a repository will take.
+
+    How long the last transfer took is the best guide, then the size of the
+    repository, if GitLab gave it. Anything else is guessed to be quick.
+
+    """
+    if entry is not None and entry.transfer_seconds is not None:
+        return entry.transfer_seconds
+    return (remote.repository_size or 0) / _TRANSFER_RATE
+
+
+class _Scheduler(object):
+    """Runs jobs as workers come free, the longest first.
+
+    Whenever a worker is free, the job estimated to take longest of those
+    waiting starts, so that a large clone found late doesn't run on its own
+    at the end of a run. If namespace_workers is set, jobs only start while
+    fewer than that many are running for the same namespace, leaving the
+    other workers to other namespaces. Jobs which have started also wait for
+    the sessions semaphore, if given, which other copies share. Jobs are kept
+    as (outcome, repo, task) for _finish_jobs.
+
+    """
+
+    def __init__(self, workers, namespace_workers=0, sessions=None):
+        self.jobs = []
+        self._sessions = sessions
+        self._free = workers
+        self._limit = namespace_workers
+        self._running = collections.Counter()
+        # waiting (-cost, order, gate) heaps for each namespace, and the
+        # (-cost, order, namespace) of the next job of each namespace which
+        # can start one, which are skipped once out of date
+        self._waiting = {}
+        self._ready = []
+        self._order = itertools.count()
+
+    def start(self, outcome, repo, job, cost=0, namespace=None):
+        """Queue a job, which starts once it is the longest a worker is free for."""
+        gate = asyncio.get_event_loop().create_future()
+        waiting = self._waiting.setdefault(namespace, [])
+        heapq.heappush(waiting, (-cost, next(self._order), gate))
+
+        async def run():
+            try:
+                await gate
+                if self._sessions is not None:
+                    await self._sessions.acquire()
+                try:
+                    with gitlab_sync.metrics.timed(
+                        "operation", outcome, repo.base_path
+                    ) as timed:
+                        result = await job()
+                        # jobs can return a different outcome to the one expected
+                        timed["name"] = result or outcome
+                        return result
+                finally:
+                    if self._sessions is not None:
+                        self._sessions.release()
+            finally:
+                if gate.done() and not gate.cancelled():
+                    self._release(namespace)
+
+        self.jobs.append((outcome, repo, asyncio.ensure_future(run())))
+        self._offer(namespace)
+        self._schedule()
+
+    def _offer(self, namespace):
+        waiting = self._waiting.get(namespace)
+        if waiting and (not self._limit or self._running[namespace] < self._limit):
+            cost, order, _ = waiting[0]
+            heapq.heappush(self._ready, (cost, order, namespace))
+
+    def _schedule(self):
+        while self._free and self._ready:
+            _, order, namespace = heapq.heappop(self._ready)
+            waiting = self._waiting.get(namespace)
+            if (
+                not waiting
+                or waiting[0][1] != order
+                or (self._limit and self._running[namespace] >= self._limit)
+            ):
+                continue
+            _, _, gate = heapq.heappop(waiting)
+            if not waiting:
+                del self._waiting[namespace]
+            if not gate.cancelled():
+                self._free -= 1
+                self._running[namespace] += 1
+                gate.set_result(None)
+            self._offer(namespace)
+
+    def _release(self, namespace):
+        self._free += 1
+        self._running[namespace] -= 1
+        self._offer(namespace)
+        self._schedule()
+
+
+async def _finish_jobs(config, jobs, unchanged=0):
+    """Wait for (outcome, repo, task) jobs and log a summary of them.
+
+    Jobs finish in whatever order they happen to, so failures are reported in
+    path order. Raises SyncError if any of the jobs failed.
+
+    """
+    if jobs:
+        await asyncio.wait([task for _, _, task in jobs])
+    counts = collections.Counter()
+    failed = []
+    for outcome, repo, task in jobs:
+        if task.exception() is None:
+            # jobs can return a different outcome to the one expected
+            counts[task.result() or outcome] += 1
+        else:
+            failed.append((repo, task.exception()))
+    failed.sort(key=lambda failure: failure[0].absolute_path)
+    for repo, error in failed:
+        logger.error("failed to sync %s: %s", repo, error)
+        logger.debug("traceback for %s", repo, exc_info=error)
+    logger.info(
+        "%s: copied %d, updated %d, unchanged %d, failed %d",
+        config.base_path,
+        counts["copied"],
+        counts["updated"],
+        unchanged + counts["unchanged"],
+        len(failed),
+    )
+    if failed:
+        raise SyncError(
+            "%d repositories failed to sync under %s: %s"
+            % (
+                len(failed),
+                config.base_path,
+                ", ".join(str(repo) for repo, _ in failed),
+            )
+        )
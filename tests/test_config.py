@@ -96,6 +96,84 @@ def test_schema(tmpdir):
     }
 
 
+def test_schema_workers(tmpdir):
+    """workers must be a positive integer, and namespace-workers not negative."""
+    settings = {"access-token": "hello", "paths": ["parent"], "strategy": "mirror"}
+    for workers in (0, -1, "4"):
+        with pytest.raises(MultipleInvalid):
+            gitlab_sync.config.schema({str(tmpdir): dict(settings, workers=workers)})
+
+    with pytest.raises(MultipleInvalid):
+        gitlab_sync.config.schema(
+            {str(tmpdir): dict(settings, **{"namespace-workers": -1})}
+        )
+
+    workers = {"workers": 4, "namespace-workers": 2}
+    data = gitlab_sync.config.schema({str(tmpdir): dict(settings, **workers)})
+    assert data[Path(tmpdir)]["workers"] == 4
+    assert data[Path(tmpdir)]["namespace_workers"] == 2
+
+
+def test_schema_api(tmpdir):
+    """Settings for requests to GitLab have to be in range."""
+    settings = {"access-token": "hello", "paths": ["parent"], "strategy": "mirror"}
+    for invalid in (
+        {"api-timeout": 0},
+        {"api-retries": -1},
+        {"api-concurrency": 0},
+        {"api-connections": 0},
+        {"api-keepalive": -1},
+    ):
+        with pytest.raises(MultipleInvalid):
+            gitlab_sync.config.schema({str(tmpdir): dict(settings, **invalid)})
+
+    api = {"api-timeout": 2.5, "api-connections": 4, "api-dns-cache": 0}
+    data = gitlab_sync.config.schema({str(tmpdir): dict(settings, **api)})
+    assert data[Path(tmpdir)]["api_connections"] == 4
+
+
+def test_schema_object_pool(tmpdir):
+    """object-pool must be absolute, and is created if needed."""
+    settings = {"access-token": "hello", "paths": ["parent"], "strategy": "mirror"}
+    with pytest.raises(MultipleInvalid):
+        gitlab_sync.config.schema({str(tmpdir): dict(settings, **{"object-pool": "x"})})
+
+    pool = tmpdir / "pool"
+    data = gitlab_sync.config.schema(
+        {str(tmpdir): dict(settings, **{"object-pool": str(pool)})}
+    )
+    assert data[Path(tmpdir)]["object_pool"] == Path(pool)
+    assert pool.isdir()
+
+
+def test_schema_trimmed(tmpdir):
+    """Clones can be trimmed, except for the history of pooled ones."""
+    settings = {"access-token": "hello", "paths": ["parent"], "strategy": "mirror"}
+    trimmed = {
+        "single-branch": True,
+        "depth": 1,
+        "filter": "blob:none",
+        "sparse-checkout": ["/README*"],
+    }
+    data = gitlab_sync.config.schema({str(tmpdir): dict(settings, **trimmed)})
+    assert data[Path(tmpdir)]["sparse_checkout"] == ["/README*"]
+
+    for invalid in ({"filter": "blob:all"}, {"depth": 0}):
+        with pytest.raises(MultipleInvalid):
+            gitlab_sync.config.schema({str(tmpdir): dict(settings, **invalid)})
+    with pytest.raises(MultipleInvalid):
+        pool = {"object-pool": str(tmpdir / "pool"), "depth": 1}
+        gitlab_sync.config.schema({str(tmpdir): dict(settings, **pool)})
+
+
+def test_valid_strategy_validator():
+    """Only the strategies of the strategy module are strategies."""
+    assert gitlab_sync.config.valid_strategy("mirror") is gitlab_sync.strategy.mirror
+    for name in ("_run_jobs", "logger", "missing", "sync_projects", "delta_since"):
+        with pytest.raises(Invalid):
+            gitlab_sync.config.valid_strategy(name)
+
+
 def test_find_and_load_config(tmpdir, monkeypatch):
     """Returns a map of paths to RunConfig objects."""
     config_file = tmpdir / "gitlab-sync.toml"
@@ -0,0 +1,106 @@
+"""Test the functionality of the daemon module."""
+from pathlib import Path
+
+import gitlab_sync.strategy
+from aiohttp import test_utils
+from gitlab_sync.config import RunConfig
+from gitlab_sync.daemon import Daemon, HookEvent, parse_event
+
+
+def test_parse_event():
+    """Events give the project and paths they affect, or None if neither."""
+    push = {
+        "object_kind": "push",
+        "event_name": "push",
+        "project_id": 15,
+        "project": {"id": 15, "path_with_namespace": "group/project"},
+    }
+    assert parse_event(push) == HookEvent(15, [Path("group/project")])
+    rename = {
+        "event_name": "project_rename",
+        "project_id": 15,
+        "path_with_namespace": "group/new",
+        "old_path_with_namespace": "group/old",
+    }
+    assert parse_event(rename) == HookEvent(15, [Path("group/new"), Path("group/old")])
+    group_rename = {
+        "event_name": "group_rename",
+        "full_path": "new",
+        "old_full_path": "old",
+    }
+    assert parse_event(group_rename) == HookEvent(None, [Path("new"), Path("old")])
+    assert parse_event({"object_kind": "merge_request"}) is None
+
+
+def test_hooks(loop):
+    """Hooks queue work for the copies they affect, coalescing projects."""
+
+    async def post_events():
+        configs = [
+            RunConfig(
+                base_path=Path("/copy-%d" % number),
+                paths=[Path(path)],
+                access_token="token",
+                strategy=strategy,
+                gitlab_http="https://gitlab.example.com/",
+            )
+            for number, (path, strategy) in enumerate(
+                [
+                    ("group", gitlab_sync.strategy.mirror),
+                    ("group/sub", gitlab_sync.strategy.mirror),
+                    ("other", gitlab_sync.strategy.snapshot),
+                ]
+            )
+        ]
+        daemon = Daemon(configs, hook_token="secret")
+        headers = {
+            "X-Gitlab-Token": "secret",
+            "X-Gitlab-Instance": "https://gitlab.example.com",
+        }
+        async with test_utils.TestClient(test_utils.TestServer(daemon.app)) as client:
+            statuses = []
+            for event, headers in [
+                ({"event_name": "push", "project_id": 1}, {}),
+                (
+                    {"event_name": "push", "project_id": 1},
+                    dict(headers, **{"X-Gitlab-Token": "wrong"}),
+                ),
+                (
+                    {"event_name": "push", "project_id": 1},
+                    dict(headers, **{"X-Gitlab-Instance": "https://other.example"}),
+                ),
+                ({"event_name": "push", "project_id": 1}, headers),
+                (
+                    {
+                        "event_name": "repository_update",
+                        "project_id": 1,
+                        "project": {"path_with_namespace": "group/one"},
+                    },
+                    headers,
+                ),
+                (
+                    {
+                        "event_name": "project_create",
+                        "project_id": 2,
+                        "path_with_namespace": "other/two",
+                    },
+                    headers,
+                ),
+                ({"event_name": "group_rename", "full_path": "group/sub"}, headers),
+            ]:
+                response = await client.post("/", json=event, headers=headers)
+                statuses.append(response.status)
+        return statuses, [
+            (sorted(copy._projects), copy._reconcile) for copy in daemon.copies
+        ]
+
+    statuses, queued = loop.run_until_complete(post_events())
+    assert statuses == [401, 401, 200, 200, 200, 200, 200]
+    assert queued == [
+        # events for the same project coalesce, and those without paths go
+        # to every copy to look up
+        ([1], True),
+        ([1], True),
+        # copies which aren't mirrors are only synchronised in full
+        ([], True),
+    ]
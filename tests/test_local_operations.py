@@ -1,5 +1,387 @@
 """Module for the testing of operations on local repositories."""
+import hashlib
+import shutil
+import subprocess
+import time
+from pathlib import Path
+
+import attr
+import gitlab_sync.operations
+import gitlab_sync.state
+import gitlab_sync.strategy
+from gitlab_sync.config import RunConfig
+from gitlab_sync.repository import GitlabRepository, LocalRepository
+
+import pytest
 
 
 def test_nothing():
     pass
+
+
+def git(path, *args):
+    return subprocess.run(
+        ["git", "-C", str(path)] + list(args),
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    ).stdout
+
+
+def push(tmp_path, upstream, content):
+    """Push a commit changing a file to an upstream repository."""
+    if not upstream.exists():
+        subprocess.run(["git", "init", "-q", "--bare", str(upstream)], check=True)
+    work = tmp_path / "work"
+    if not work.exists():
+        subprocess.run(["git", "init", "-q", str(work)], check=True)
+    (work / "file").write_text(content)
+    git(work, "add", "file")
+    git(work, "-c", "user.name=x", "-c", "user.email=x@x", "commit", "-qm", "x")
+    git(work, "push", "-q", str(upstream), "HEAD:refs/heads/master")
+
+
+def make_config(tmp_path, **settings):
+    return RunConfig(
+        base_path=tmp_path / "copy",
+        paths=[Path("group")],
+        access_token="token",
+        strategy=gitlab_sync.strategy.mirror,
+        gitlab_http="https://gitlab.example.com/",
+        gitlab_git="file://%s/" % (tmp_path / "gitlab"),
+        **settings
+    )
+
+
+async def listing(*remotes):
+    """Yield remote repositories as an enumeration of GitLab would."""
+    for remote in remotes:
+        yield remote
+
+
+def test_object_pool(loop, tmp_path):
+    """Forks borrow objects from a shared pool, which keeps refs per member."""
+    upstream = tmp_path / "gitlab" / "group" / "project.git"
+    push(tmp_path, upstream, "content\n")
+    fork = upstream.with_name("fork.git")
+    subprocess.run(["git", "clone", "-q", "--bare", str(upstream), str(fork)])
+
+    alone = upstream.with_name("alone.git")
+    subprocess.run(["git", "clone", "-q", "--bare", str(upstream), str(alone)])
+
+    config = make_config(tmp_path, object_pool=tmp_path / "pool")
+    remotes = [
+        GitlabRepository(Path("group/project"), 1, forks_count=1),
+        GitlabRepository(Path("group/fork"), 2, forked_from_id=1, forks_count=0),
+        GitlabRepository(Path("group/alone"), 3, forks_count=0),
+    ]
+
+    async def sync():
+        with gitlab_sync.state.StateIndex(config.base_path) as index:
+            for remote in remotes:
+                local = LocalRepository.from_remote(config, remote)
+                await gitlab_sync.strategy._copy(config, index, local, remote)
+
+    config.base_path.mkdir()
+    loop.run_until_complete(sync())
+    pool = tmp_path / "pool" / "gitlab.example.com" / "1.git"
+    assert sorted(path.name for path in pool.parent.iterdir()) == ["1.git"]
+    members = git(pool, "for-each-ref", "--format=%(refname)").split()
+    assert {ref.split("/")[3] for ref in members} == {"1", "2"}
+    for name in ("project", "fork"):
+        repo = config.base_path / "group" / name
+        git(repo, "fsck", "--connectivity-only")
+        assert (repo / "file").read_text() == "content\n"
+        # members keep no copies of the objects in the pool
+        counts = dict(
+            line.split(": ") for line in git(repo, "count-objects", "-v").splitlines()
+        )
+        assert counts["count"] == "0" and counts["in-pack"] == "0"
+    alternates = config.base_path / "group" / "alone" / ".git" / "objects" / "info"
+    assert not (alternates / "alternates").exists()
+
+    async def leave():
+        local = LocalRepository(config.base_path, Path("group/fork"))
+        joined = gitlab_sync.operations.joined_pool(config, local)
+        assert joined.absolute_path == pool
+        await gitlab_sync.operations.leave_pool(local, joined)
+
+    loop.run_until_complete(leave())
+    members = git(pool, "for-each-ref", "--format=%(refname)").split()
+    assert {ref.split("/")[3] for ref in members} == {"1"}
+
+
+def test_update_skipped_when_refs_match(loop, tmp_path):
+    """Repositories are only updated when the remote refs have changed."""
+    upstream = tmp_path / "gitlab" / "group" / "project.git"
+    push(tmp_path, upstream, "first\n")
+    config = make_config(tmp_path)
+    config.base_path.mkdir()
+    remote = GitlabRepository(Path("group/project"), 1)
+    local = LocalRepository.from_remote(config, remote)
+
+    def update():
+        async def update():
+            with gitlab_sync.state.StateIndex(config.base_path) as index:
+                entry = index.entries()[local.relative_path]
+                return await gitlab_sync.strategy._update(
+                    config, index, local, remote, entry
+                )
+
+        return loop.run_until_complete(update())
+
+    async def copy():
+        with gitlab_sync.state.StateIndex(config.base_path) as index:
+            await gitlab_sync.strategy._copy(config, index, local, remote)
+
+    loop.run_until_complete(copy())
+    assert update() == "unchanged"
+
+    push(tmp_path, upstream, "second\n")
+    assert update() is None
+    assert (local.absolute_path / "file").read_text() == "second\n"
+    assert update() == "unchanged"
+
+    # changes to what is fetched and checked out, and full runs, update anyway
+    config = attr.evolve(config, sparse_checkout=["/other"])
+    assert update() is None
+    assert not (local.absolute_path / "file").exists()
+    assert update() == "unchanged"
+    config = attr.evolve(config, ref_check="none")
+    assert update() is None
+
+
+def test_interrupted_run_recovered(loop, tmp_path):
+    """Part done clones are rolled back, and moves finished, on the next run."""
+    upstream = tmp_path / "gitlab" / "group" / "project.git"
+    push(tmp_path, upstream, "content\n")
+    subprocess.run(
+        [
+            "git",
+            "clone",
+            "-q",
+            "--bare",
+            str(upstream),
+            str(upstream.parent / "old.git"),
+        ]
+    )
+    config = make_config(tmp_path)
+    config.base_path.mkdir()
+    old = GitlabRepository(Path("group/old"), 1)
+    moved = GitlabRepository(Path("group/project"), 1)
+    local = LocalRepository.from_remote(config, moved)
+
+    async def copy():
+        with gitlab_sync.state.StateIndex(config.base_path) as index:
+            repo = LocalRepository.from_remote(config, old)
+            await gitlab_sync.strategy._copy(config, index, repo, old)
+
+    loop.run_until_complete(copy())
+    # the copy was moved on disk, and a clone started, then the run stopped
+    with gitlab_sync.state.StateIndex(config.base_path) as index:
+        index.begin("move", Path("group/old"), 1, Path("group/project"))
+        index.begin("clone", Path("group/partial"), 2)
+    (config.base_path / "group/old").rename(local.absolute_path)
+    subprocess.run(["git", "init", "-q", str(config.base_path / "group/partial")])
+
+    async def remotes():
+        yield moved
+
+    loop.run_until_complete(gitlab_sync.strategy.mirror(config, remotes()))
+    assert not (config.base_path / "group/partial").exists()
+    assert git(local.absolute_path, "config", "gitlab-sync.gitlab-path") == (
+        "group/project\n"
+    )
+    with gitlab_sync.state.StateIndex(config.base_path) as index:
+        assert index.journal() == []
+        assert set(index.entries()) == {Path("group/project")}
+
+
+def test_delta_listing(loop, tmp_path):
+    """Listings of active projects update them, but don't delete the rest."""
+    push(tmp_path, tmp_path / "gitlab" / "group" / "project.git", "content\n")
+    config = make_config(tmp_path, delta_listing=True, maintenance_budget=0)
+    config.base_path.mkdir()
+    local = config.base_path / "group" / "project"
+
+    def mirror(since, *repos):
+        loop.run_until_complete(
+            gitlab_sync.strategy.mirror(config, listing(*repos), since=since)
+        )
+
+    assert gitlab_sync.strategy.delta_since(config) is None
+    started = time.time()
+    mirror(None, GitlabRepository(Path("group/project"), 1))
+    assert local.exists()
+    since = gitlab_sync.strategy.delta_since(config)
+    # GitLab can take up to an hour to update activity times
+    assert started - 60 * 60 <= since <= time.time() - 60 * 60
+
+    mirror(since)
+    assert local.exists()
+    # listings of every project are needed for other paths, or after a while
+    for settings in ({"paths": [Path("other")]}, {"full_listing_interval": 0}):
+        assert gitlab_sync.strategy.delta_since(attr.evolve(config, **settings)) is None
+
+    mirror(None)
+    assert not local.exists()
+
+
+def test_mirror_reads_no_git_config(loop, tmp_path, monkeypatch):
+    """Runs after the first take what they know of repositories from the index."""
+    push(tmp_path, tmp_path / "gitlab" / "group" / "project.git", "content\n")
+    config = make_config(tmp_path, maintenance_budget=0)
+    config.base_path.mkdir()
+    remote = GitlabRepository(Path("group/project"), 1)
+    loop.run_until_complete(gitlab_sync.strategy.mirror(config, listing(remote)))
+
+    commands = []
+    git_async = LocalRepository.git_async
+
+    def record(self, *args, **kwargs):
+        commands.append(args[0])
+        return git_async(self, *args, **kwargs)
+
+    monkeypatch.setattr(LocalRepository, "git", lambda *args, **kwargs: 1 / 0)
+    monkeypatch.setattr(LocalRepository, "git_async", record)
+    loop.run_until_complete(gitlab_sync.strategy.mirror(config, listing(remote)))
+    assert "config" not in commands
+
+
+def test_git_async(loop, tmp_path):
+    """git_async runs git like git does, with input and captured output."""
+    repo = LocalRepository(tmp_path, Path("repo"))
+    subprocess.run(["git", "init", "-q", str(repo.absolute_path)], check=True)
+
+    def run(*args, **kwargs):
+        return loop.run_until_complete(repo.git_async(*args, **kwargs))
+
+    result = run(
+        "hash-object",
+        "-w",
+        "--stdin",
+        input="content\n",
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    blob = hashlib.sha1(b"blob 8\0content\n").hexdigest()
+    assert result.returncode == 0
+    assert result.stdout == blob + "\n"
+    assert run("cat-file", "-p", blob, stdout=subprocess.PIPE).stdout == (b"content\n")
+    with pytest.raises(subprocess.CalledProcessError):
+        run("cat-file", "-t", "0" * 40, stderr=subprocess.PIPE)
+    result = run("cat-file", "-t", "0" * 40, check=False, stderr=subprocess.PIPE)
+    assert result.returncode != 0
+    assert result.stderr
+
+
+def test_mirror_waits_for_deletes_and_moves(loop, tmp_path, monkeypatch):
+    """Copies into occupied paths, and updates of moved repositories, wait."""
+    gitlab = tmp_path / "gitlab" / "group"
+    push(tmp_path, gitlab / "reused.git", "first\n")
+    push(tmp_path, gitlab / "old.git", "moved\n")
+    config = make_config(tmp_path, maintenance_budget=0)
+    config.base_path.mkdir()
+    loop.run_until_complete(
+        gitlab_sync.strategy.mirror(
+            config,
+            listing(
+                GitlabRepository(Path("group/reused"), 1),
+                GitlabRepository(Path("group/old"), 2),
+            ),
+        )
+    )
+
+    # project 1 was deleted and another took its path, and project 2 moved
+    # and changed, with a new project taking its old path
+    shutil.rmtree(str(gitlab / "reused.git"))
+    push(tmp_path, gitlab / "reused.git", "second\n")
+    (gitlab / "old.git").rename(gitlab / "new.git")
+    push(tmp_path, gitlab / "new.git", "changed\n")
+    push(tmp_path, gitlab / "old.git", "replaced\n")
+    events = []
+    for name in ("_copy", "_update", "_delete", "_move"):
+
+        def record(*args, _name=name, _function=getattr(gitlab_sync.strategy, name)):
+            repo = next(arg for arg in args if isinstance(arg, LocalRepository))
+            events.append((_name, str(repo.relative_path)))
+            return _function(*args)
+
+        monkeypatch.setattr(gitlab_sync.strategy, name, record)
+    loop.run_until_complete(
+        gitlab_sync.strategy.mirror(
+            config,
+            listing(
+                GitlabRepository(Path("group/reused"), 3),
+                GitlabRepository(Path("group/old"), 4),
+                GitlabRepository(Path("group/new"), 2),
+            ),
+        )
+    )
+    for name, project_id in (("reused", 3), ("old", 4), ("new", 2)):
+        path = config.base_path / "group" / name
+        assert git(path, "config", "gitlab-sync.project-id") == "%d\n" % project_id
+    assert (config.base_path / "group/reused/file").read_text() == "second\n"
+    assert (config.base_path / "group/old/file").read_text() == "replaced\n"
+    assert (config.base_path / "group/new/file").read_text() == "changed\n"
+    assert events.index(("_delete", "group/reused")) < events.index(
+        ("_copy", "group/reused")
+    )
+    assert events.index(("_move", "group/old")) < events.index(("_copy", "group/old"))
+    assert events.index(("_move", "group/old")) < events.index(("_update", "group/new"))
+
+
+def test_trimmed_copy(loop, tmp_path):
+    """Copies and updates only fetch and check out what the settings ask for."""
+    upstream = tmp_path / "gitlab" / "group" / "project.git"
+    push(tmp_path, upstream, "first\n")
+    work = tmp_path / "work"
+    (work / "src").mkdir()
+    (work / "src" / "code").write_text("code\n")
+    git(work, "add", "src")
+    git(work, "-c", "user.name=x", "-c", "user.email=x@x", "commit", "-qm", "x")
+    git(work, "push", "-q", str(upstream), "HEAD:refs/heads/master")
+    git(work, "push", "-q", str(upstream), "HEAD:refs/heads/other")
+    git(upstream, "config", "uploadpack.allowFilter", "true")
+    config = make_config(
+        tmp_path,
+        single_branch=True,
+        depth=1,
+        filter="blob:none",
+        sparse_checkout=["/file"],
+    )
+    config.base_path.mkdir()
+    remote = GitlabRepository(Path("group/project"), 1, default_branch="master")
+    local = LocalRepository.from_remote(config, remote)
+
+    def check(content):
+        path = local.absolute_path
+        refs = git(path, "for-each-ref", "--format=%(refname)", "refs/remotes")
+        assert refs.split() == [
+            "refs/remotes/origin/HEAD",
+            "refs/remotes/origin/master",
+        ]
+        assert (path / ".git" / "shallow").exists()
+        assert git(path, "rev-list", "--count", "HEAD") == "1\n"
+        assert git(path, "config", "remote.origin.partialclonefilter") == (
+            "blob:none\n"
+        )
+        assert (path / "file").read_text() == content
+        assert not (path / "src").exists()
+
+    async def copy():
+        with gitlab_sync.state.StateIndex(config.base_path) as index:
+            await gitlab_sync.strategy._copy(config, index, local, remote)
+
+    loop.run_until_complete(copy())
+    check("first\n")
+
+    push(tmp_path, upstream, "second\n")
+
+    async def update():
+        with gitlab_sync.state.StateIndex(config.base_path) as index:
+            entry = index.entries()[local.relative_path]
+            await gitlab_sync.strategy._update(config, index, local, remote, entry)
+
+    loop.run_until_complete(update())
+    check("second\n")
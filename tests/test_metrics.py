@@ -0,0 +1,84 @@
+"""Test the functionality of the metrics module."""
+import asyncio
+import json
+import os
+
+import pytest
+from gitlab_sync.metrics import Metrics
+
+
+def test_metrics(tmp_path):
+    """Timings and counters are reported as JSON and for Prometheus."""
+    metrics = Metrics()
+    with metrics.timed("phase", "enumerate_local", tmp_path):
+        pass
+    with pytest.raises(ValueError):
+        with metrics.timed("operation", "copied", tmp_path):
+            raise ValueError
+    with metrics.timed("operation", "updated", tmp_path) as timed:
+        timed["name"] = "unchanged"
+    metrics.count("http_requests")
+    metrics.count("http_received_bytes", 100)
+
+    metrics.write_json(tmp_path / "report.json", succeeded=False)
+    report = json.loads((tmp_path / "report.json").read_text())
+    assert report["succeeded"] is False
+    assert [
+        (timing["kind"], timing["name"], timing["count"], timing["failed"])
+        for timing in report["timings"]
+    ] == [
+        ("operation", "copied", 1, 1),
+        ("operation", "unchanged", 1, 0),
+        ("phase", "enumerate_local", 1, 0),
+    ]
+    assert report["counters"] == {"http_received_bytes": 100, "http_requests": 1}
+
+    metrics.write_prometheus(tmp_path / "report.prom")
+    lines = (tmp_path / "report.prom").read_text().splitlines()
+    assert "gitlab_sync_last_run_success 1" in lines
+    assert (
+        "# HELP gitlab_sync_run_count Number of phases, operations, and git commands"
+        " in the last run." in lines
+    )
+    assert (
+        'gitlab_sync_run_failed{kind="operation",name="copied",copy="%s"} 1' % tmp_path
+        in lines
+    )
+    assert 'gitlab_sync_run_counter{name="http_requests"} 1' in lines
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_report_readable(tmp_path):
+    """Reports can be read by collectors running as other users."""
+    umask = os.umask(0o027)
+    try:
+        Metrics().write_prometheus(tmp_path / "report.prom")
+    finally:
+        os.umask(umask)
+    assert (tmp_path / "report.prom").stat().st_mode & 0o777 == 0o640
+
+
+def test_trace(tmp_path, loop):
+    """Traces have an event per timing, in a lane for each task."""
+    metrics = Metrics()
+    metrics.start_trace()
+
+    async def job(name):
+        with metrics.timed("git", name, argv=["git", name]):
+            await asyncio.sleep(0.01)
+
+    async def run():
+        await asyncio.gather(job("fetch"), job("fetch"))
+        await job("gc")
+
+    loop.run_until_complete(run())
+    metrics.write_trace(tmp_path / "trace.json")
+    events = json.loads((tmp_path / "trace.json").read_text())["traceEvents"]
+    assert [(event["name"], event["tid"]) for event in events] == [
+        ("fetch", 0),
+        ("fetch", 1),
+        # the lanes of finished tasks are reused
+        ("gc", 0),
+    ]
+    assert events[0]["ph"] == "X"
+    assert events[0]["args"]["argv"] == ["git", "fetch"]
@@ -1,5 +1,566 @@
 """Module for the testing of operations on remote repositories."""
+import asyncio
+import hashlib
+import io
+import subprocess
+import tarfile
+import time
+from pathlib import Path
 
+import gitlab_sync.api
+import gitlab_sync.strategy
+import gitlab_sync.state
+from aiohttp import test_utils, web
+from gitlab_sync.config import RunConfig
+from gitlab_sync.api import ApiError, api_session
+from gitlab_sync.repository import (
+    GitlabRepository,
+    HeadLoader,
+    ProjectCollector,
+    share_enumerations,
+)
 
-def test_nothing():
-    pass
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    return tmp_path / "cache"
+
+
+class FakeGitLab:
+    """Serves GitLab API listings from a map of paths to lists of items."""
+
+    def __init__(self, listings, total_pages=True, files=None):
+        self.listings = listings
+        # responses which aren't listings, as bytes or JSON
+        self.files = files or {}
+        # (status, headers) of responses to give before any real ones
+        self.failures = []
+        self.total_pages = total_pages
+        self.requests = []
+        self.not_modified = 0
+        # a fixed port so cached responses are for the same URLs every time
+        self.port = test_utils.unused_port()
+        self.app = web.Application()
+        self.app.router.add_get("/api/v4/{path:.*}", self.handle)
+        self.app.router.add_post("/api/graphql", self.handle_graphql)
+
+    async def handle(self, request):
+        self.requests.append(request)
+        if self.failures:
+            status, headers = self.failures.pop(0)
+            return web.json_response(
+                {"message": "failure"}, status=status, headers=headers
+            )
+        path = request.match_info["path"]
+        if path in self.files:
+            if isinstance(self.files[path], bytes):
+                return web.Response(body=self.files[path])
+            return web.json_response(self.files[path])
+        if request.query.get("include_subgroups") == "true":
+            # only servers new enough to know include_subgroups have these
+            path = self.listings.get(path + "?include_subgroups", path)
+        if path not in self.listings:
+            return web.json_response({"message": "404 Not Found"}, status=404)
+        items = self.listings[path]
+        per_page = int(request.query["per_page"])
+        if "id_after" in request.query:
+            items = [
+                item for item in items if item["id"] > int(request.query["id_after"])
+            ]
+            return web.json_response(items[:per_page])
+        page = int(request.query.get("page", 1))
+        headers = {}
+        pages = max(1, -(-len(items) // per_page))
+        if self.total_pages:
+            headers["X-Total-Pages"] = str(pages)
+        headers["X-Next-Page"] = str(page + 1) if page < pages else ""
+        response = web.json_response(
+            items[(page - 1) * per_page : page * per_page], headers=headers
+        )
+        response.headers["ETag"] = 'W/"%s"' % hashlib.md5(response.body).hexdigest()
+        if request.headers.get("If-None-Match") == response.headers["ETag"]:
+            self.not_modified += 1
+            return web.Response(status=304, headers={"ETag": response.headers["ETag"]})
+        return response
+
+    async def handle_graphql(self, request):
+        self.requests.append(request)
+        variables = (await request.json())["variables"]
+        if "ids" in variables:
+            return self.handle_heads(variables["ids"])
+        items = self.listings.get("graphql/" + variables["fullPath"])
+        if items is None:
+            return web.json_response({"data": {"group": None}})
+        start = int(variables["after"] or 0)
+        nodes = [
+            {
+                "id": "gid://gitlab/Project/%d" % item["id"],
+                "fullPath": item["path_with_namespace"],
+                "lastActivityAt": None,
+                "repository": {"rootRef": "main"},
+            }
+            for item in items[start : start + 100]
+        ]
+        page_info = {
+            "hasNextPage": start + 100 < len(items),
+            "endCursor": str(start + 100),
+        }
+        projects = {"pageInfo": page_info, "nodes": nodes}
+        return web.json_response({"data": {"group": {"projects": projects}}})
+
+    def handle_heads(self, ids):
+        nodes = []
+        for gid in ids:
+            head = self.listings.get("heads/" + gid.rpartition("/")[2])
+            if head is not None:
+                repository = {
+                    "rootRef": head[0],
+                    "tree": {"lastCommit": {"sha": head[1]}},
+                }
+                nodes.append({"id": gid, "repository": repository})
+        return web.json_response({"data": {"projects": {"nodes": nodes}}})
+
+    def paths_requested(self):
+        return [request.match_info.get("path") for request in self.requests]
+
+    def collect(self, loop, paths, enumeration="auto", since=None, **settings):
+        async def collect():
+            async with test_utils.TestServer(self.app, port=self.port) as server:
+                config = RunConfig(
+                    base_path=Path("/nonexistent"),
+                    paths=[Path(path) for path in paths],
+                    access_token="token",
+                    strategy=gitlab_sync.strategy.mirror,
+                    gitlab_http=str(server.make_url("/")),
+                    enumeration=enumeration,
+                    **settings
+                )
+                collector = ProjectCollector(config, since=since)
+                return [repo async for repo in collector.iter_projects()]
+
+        return loop.run_until_complete(collect())
+
+
+def projects(namespace, ids):
+    return [
+        {"id": id_, "path_with_namespace": "%s/project-%d" % (namespace, id_)}
+        for id_ in ids
+    ]
+
+
+@pytest.mark.parametrize("total_pages", [True, False])
+def test_paginated_group_projects(loop, total_pages):
+    """Every page of a large group is collected with or without X-Total-Pages."""
+    gitlab = FakeGitLab(
+        {
+            "groups/group/subgroups": [],
+            "groups/group/projects": projects("group", range(1, 251)),
+        },
+        total_pages=total_pages,
+    )
+    repos = gitlab.collect(loop, ["group"])
+    assert sorted(repo.gitlab_project_id for repo in repos) == list(range(1, 251))
+
+    project_requests = [
+        request.query
+        for request in gitlab.requests
+        if request.match_info["path"] == "groups/group/projects"
+    ]
+    assert len(project_requests) == 3
+    if total_pages:
+        assert sorted(query["page"] for query in project_requests) == ["1", "2", "3"]
+    else:
+        assert [query.get("id_after") for query in project_requests] == [
+            None,
+            "100",
+            "200",
+        ]
+
+
+def test_keyset_pages_must_move_on(loop):
+    """Keyset paging stops when a page doesn't go past the one before it."""
+    gitlab = FakeGitLab({"groups/group/subgroups": []}, total_pages=False)
+    # id_after is ignored, so the same page comes back every time
+    gitlab.files["groups/group/projects"] = projects("group", range(1, 101))
+    repos = gitlab.collect(loop, ["group"])
+    assert sorted(repo.gitlab_project_id for repo in repos) == list(range(1, 101))
+    assert [
+        request.query.get("id_after")
+        for request in gitlab.requests
+        if request.match_info["path"] == "groups/group/projects"
+    ] == [None, "100"]
+
+
+def test_subgroups_and_users(loop):
+    """Projects of subgroups and users are collected, and filtered by path."""
+    gitlab = FakeGitLab(
+        {
+            "groups/group/subgroups": [{"id": 2}],
+            "groups/group/projects": projects("group", [1]),
+            "groups/2/subgroups": [],
+            "groups/2/projects": projects("group/sub", [3, 4]),
+            "users/user/projects": projects("user", [5]),
+        },
+        total_pages=False,
+    )
+    repos = gitlab.collect(loop, ["group/sub", "user"])
+    assert sorted(str(repo) for repo in repos) == [
+        "group/sub/project-3",
+        "group/sub/project-4",
+        "user/project-5",
+    ]
+
+
+def test_include_subgroups(loop):
+    """Servers which support include_subgroups aren't walked group by group."""
+    descendants = projects("group", [1]) + projects("group/sub", [3])
+    listings = {
+        "groups/group/subgroups": [{"id": 2}],
+        "groups/group/projects": projects("group", [1]),
+        "groups/group/projects?include_subgroups": "descendants",
+        "descendants": descendants,
+        "groups/2/subgroups": [],
+        "groups/2/projects": projects("group/sub", [3]),
+    }
+    gitlab = FakeGitLab(listings)
+    repos = gitlab.collect(loop, ["group"])
+    assert sorted(repo.gitlab_project_id for repo in repos) == [1, 3]
+    assert gitlab.paths_requested() == ["groups/group/projects"]
+
+    # old servers ignore include_subgroups, so subgroups get walked
+    del listings["groups/group/projects?include_subgroups"]
+    gitlab = FakeGitLab(listings)
+    repos = gitlab.collect(loop, ["group"])
+    assert sorted(repo.gitlab_project_id for repo in repos) == [1, 3]
+    assert "groups/2/projects" in gitlab.paths_requested()
+
+
+def test_active_projects(loop):
+    """Only pages of projects under the paths with activity since are requested."""
+    active = projects("group", range(1, 121))
+    for item in active:
+        item["last_activity_at"] = "2020-01-02T00:00:00Z"
+    old = projects("group", range(121, 301))
+    for item in old:
+        item["last_activity_at"] = "2019-01-01T00:00:00Z"
+    user = projects("user", [400])
+    user[0]["last_activity_at"] = "2020-01-01T00:00:00.000Z"
+    gitlab = FakeGitLab(
+        {
+            "groups/group/projects?include_subgroups": "descendants",
+            "descendants": active + old,
+            "users/user/projects": user,
+            "groups/other/projects": projects("other", [500]),
+            "projects": projects("everyone", [600]),
+        }
+    )
+    repos = gitlab.collect(loop, ["group", "user"], since=1577836800)
+    assert sorted(repo.gitlab_project_id for repo in repos) == list(range(1, 121)) + [
+        400
+    ]
+    assert sorted(gitlab.paths_requested()) == [
+        "groups/group/projects",
+        "groups/group/projects",
+        "groups/user/projects",
+        "users/user/projects",
+    ]
+    query = gitlab.requests[0].query
+    assert query["last_activity_after"] == "2020-01-01T00:00:00Z"
+    assert query["order_by"] == "last_activity_at"
+
+
+def test_graphql(loop):
+    """Projects of groups can be listed through GraphQL."""
+    gitlab = FakeGitLab(
+        {
+            "graphql/group": projects("group", range(1, 151)),
+            "users/user/projects": projects("user", [200]),
+        }
+    )
+    repos = gitlab.collect(loop, ["group", "user"], enumeration="graphql")
+    assert sorted(repo.gitlab_project_id for repo in repos) == (
+        list(range(1, 151)) + [200]
+    )
+    assert {repo.default_branch for repo in repos if repo.gitlab_project_id < 200} == {
+        "main"
+    }
+
+
+def test_retries(loop, monkeypatch):
+    """Requests are retried after server errors, and rate limits are followed."""
+    monkeypatch.setattr(gitlab_sync.api, "_BACKOFF", 0.01)
+    listings = {
+        "groups/group/subgroups": [],
+        "groups/group/projects": projects("group", range(1, 11)),
+    }
+    gitlab = FakeGitLab(listings)
+    rate_limit = {"RateLimit-Remaining": "0", "RateLimit-Reset": str(time.time())}
+    gitlab.failures = [(502, {}), (429, dict(rate_limit, **{"Retry-After": "0"}))]
+    repos = gitlab.collect(loop, ["group"], http_cache=False)
+    assert sorted(repo.gitlab_project_id for repo in repos) == list(range(1, 11))
+
+    gitlab = FakeGitLab(listings)
+    gitlab.failures = [(502, {})] * 3
+    with pytest.raises(ApiError, match="502"):
+        gitlab.collect(loop, ["group"], http_cache=False, api_retries=2)
+
+
+def test_http_cache(loop, cache_home):
+    """Unchanged pages are revalidated rather than downloaded again."""
+    listings = {
+        "groups/group/subgroups": [],
+        "groups/group/projects": projects("group", range(1, 151)),
+    }
+    gitlab = FakeGitLab(listings)
+    assert len(gitlab.collect(loop, ["group"])) == 150
+    assert gitlab.not_modified == 0
+
+    assert len(gitlab.collect(loop, ["group"])) == 150
+    assert gitlab.not_modified == 3
+
+    listings["groups/group/projects"] = projects("group", range(1, 152))
+    assert len(gitlab.collect(loop, ["group"])) == 151
+
+    gitlab = FakeGitLab(listings)
+    assert len(gitlab.collect(loop, ["group"], http_cache=False)) == 151
+    assert gitlab.not_modified == 0
+
+    # everything is evicted when the cache can't hold anything
+    gitlab.collect(loop, ["group"], http_cache_size=0)
+    assert not list(cache_home.glob("gitlab-sync/http/*/*.json"))
+
+
+def test_shared_enumeration(loop):
+    """Copies using the same GitLab share one enumeration, filtered per copy."""
+    gitlab = FakeGitLab(
+        {
+            "groups/group/projects": projects("group", [1])
+            + projects("group/sub", [2]),
+            "users/user/projects": projects("user", [3]),
+        }
+    )
+
+    async def enumerate_copies():
+        async with test_utils.TestServer(gitlab.app, port=gitlab.port) as server:
+            configs = [
+                RunConfig(
+                    base_path=Path("/copy-%d" % number),
+                    paths=[Path(path) for path in paths],
+                    access_token="token",
+                    strategy=gitlab_sync.strategy.mirror,
+                    gitlab_http=str(server.make_url("/")),
+                    http_cache=False,
+                )
+                for number, paths in enumerate([["group"], ["group/sub", "user"]])
+            ]
+            (enumeration,) = share_enumerations(configs)
+
+            async def collect(config):
+                return sorted(
+                    [
+                        repo.gitlab_project_id
+                        async for repo in enumeration.remotes(config)
+                    ]
+                )
+
+            *collected, _ = await asyncio.gather(
+                *[collect(config) for config in configs], enumeration.run()
+            )
+            return collected
+
+    assert loop.run_until_complete(enumerate_copies()) == [[1, 2], [2, 3]]
+    assert sorted(gitlab.paths_requested()) == [
+        "groups/group/projects",
+        "groups/user/projects",
+        "users/user/projects",
+    ]
+
+
+def test_shared_enumeration_cancelled(loop):
+    """Copies don't take a listing which was cancelled as complete."""
+    config = RunConfig(
+        base_path=Path("/copy"),
+        paths=[Path("group")],
+        access_token="token",
+        strategy=gitlab_sync.strategy.mirror,
+        gitlab_http="https://gitlab.example.com/",
+    )
+    (enumeration,) = share_enumerations([config])
+
+    async def iter_projects():
+        yield GitlabRepository(Path("group/project"), 1)
+        await asyncio.sleep(60)
+
+    enumeration.collector.iter_projects = iter_projects
+
+    async def enumerate_copy():
+        listing = asyncio.ensure_future(enumeration.run())
+        collected = []
+        with pytest.raises(asyncio.CancelledError):
+            async for repo in enumeration.remotes(config):
+                collected.append(repo.gitlab_project_id)
+                listing.cancel()
+        return collected
+
+    assert loop.run_until_complete(enumerate_copy()) == [1]
+
+
+def archive(top, files):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w:gz") as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo("%s/%s" % (top, name))
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return data.getvalue()
+
+
+def test_snapshot(loop, tmp_path):
+    """Snapshots are downloaded, and only again when the head changes."""
+    listings = {
+        "groups/group/subgroups": [],
+        "groups/group/projects": [
+            {"id": 1, "path_with_namespace": "group/one", "default_branch": "main"},
+            {"id": 2, "path_with_namespace": "group/empty", "default_branch": None},
+        ],
+    }
+    files = {
+        "projects/1/repository/branches/main": {"commit": {"id": "a" * 40}},
+        "projects/1/repository/archive.tar.gz": archive(
+            "one-aaaa", {"README": b"first\n"}
+        ),
+    }
+    gitlab = FakeGitLab(listings, files=files)
+    copy = tmp_path / "copy"
+    copy.mkdir()
+
+    def sync():
+        async def snapshot():
+            async with test_utils.TestServer(gitlab.app, port=gitlab.port) as server:
+                config = RunConfig(
+                    base_path=copy,
+                    paths=[Path("group")],
+                    access_token="token",
+                    strategy=gitlab_sync.strategy.snapshot,
+                    gitlab_http=str(server.make_url("/")),
+                    http_cache=False,
+                )
+                await gitlab_sync.strategy.snapshot(config)
+
+        gitlab.requests = []
+        loop.run_until_complete(snapshot())
+        return gitlab.paths_requested()
+
+    assert "projects/1/repository/archive.tar.gz" in sync()
+    assert (copy / "group/one/README").read_text() == "first\n"
+    assert (copy / "group/empty").is_dir()
+
+    assert "projects/1/repository/archive.tar.gz" not in sync()
+
+    files["projects/1/repository/branches/main"]["commit"]["id"] = "b" * 40
+    files["projects/1/repository/archive.tar.gz"] = archive(
+        "one-bbbb", {"LICENSE": b"second\n"}
+    )
+    listings["groups/group/projects"][0]["path_with_namespace"] = "group/moved"
+    del listings["groups/group/projects"][1]
+    # as left by a run killed while replacing the snapshot
+    old = copy / gitlab_sync.state.STATE_DIRECTORY / "snapshots" / "1.old"
+    old.mkdir(parents=True)
+    (old / "README").write_text("stale\n")
+    assert "projects/1/repository/archive.tar.gz" in sync()
+    assert not old.exists()
+    assert sorted(path.name for path in (copy / "group").iterdir()) == ["moved"]
+    assert sorted(path.name for path in (copy / "group/moved").iterdir()) == [
+        ".gitlab-sync-snapshot",
+        "LICENSE",
+    ]
+
+
+def test_sync_projects(loop, tmp_path):
+    """Projects are copied, moved, and deleted when hooks say they changed."""
+    upstream = tmp_path / "gitlab" / "group" / "one.git"
+    work = tmp_path / "work"
+    subprocess.run(["git", "init", "-q", "--bare", str(upstream)], check=True)
+    subprocess.run(["git", "init", "-q", str(work)], check=True)
+    (work / "file").write_text("content\n")
+    for args in (
+        ["add", "file"],
+        ["-c", "user.name=x", "-c", "user.email=x@x", "commit", "-qm", "x"],
+        ["push", "-q", str(upstream), "HEAD:refs/heads/master"],
+    ):
+        subprocess.run(["git", "-C", str(work)] + args, check=True)
+    files = {
+        "projects/1": {"id": 1, "path_with_namespace": "group/one"},
+        "projects/2": {"id": 2, "path_with_namespace": "other/two"},
+    }
+    gitlab = FakeGitLab({}, files=files)
+    copy = tmp_path / "copy"
+    copy.mkdir()
+
+    def sync(*project_ids):
+        async def sync_projects():
+            async with test_utils.TestServer(gitlab.app, port=gitlab.port) as server:
+                config = RunConfig(
+                    base_path=copy,
+                    paths=[Path("group")],
+                    access_token="token",
+                    strategy=gitlab_sync.strategy.mirror,
+                    gitlab_http=str(server.make_url("/")),
+                    gitlab_git="file://%s/" % (tmp_path / "gitlab"),
+                    http_cache=False,
+                )
+                return await gitlab_sync.strategy.sync_projects(
+                    config, list(project_ids)
+                )
+
+        return loop.run_until_complete(sync_projects())
+
+    # only projects under the configured paths are copied
+    assert sync(1, 2) is False
+    assert (copy / "group/one/file").read_text() == "content\n"
+    assert sorted(path.name for path in copy.iterdir()) == [".gitlab-sync", "group"]
+
+    upstream.rename(upstream.with_name("renamed.git"))
+    files["projects/1"]["path_with_namespace"] = "group/renamed"
+    assert sync(1) is False
+    assert sorted(path.name for path in (copy / "group").iterdir()) == ["renamed"]
+    assert (copy / "group/renamed/file").exists()
+
+    # projects in the way of others are left to a full run
+    files["projects/3"] = {"id": 3, "path_with_namespace": "group/renamed/nested"}
+    assert sync(3) is True
+    assert not (copy / "group/renamed/nested").exists()
+
+    del files["projects/1"]
+    assert sync(1) is False
+    assert not (copy / "group/renamed").exists()
+
+
+def test_head_loader(loop):
+    """Heads of projects asked for together are loaded in batches."""
+    gitlab = FakeGitLab(
+        {"heads/%d" % id_: ["main", "%040d" % id_] for id_ in range(1, 150)}
+    )
+
+    async def load():
+        async with test_utils.TestServer(gitlab.app, port=gitlab.port) as server:
+            config = RunConfig(
+                base_path=Path("/nonexistent"),
+                paths=[Path("group")],
+                access_token="token",
+                strategy=gitlab_sync.strategy.mirror,
+                gitlab_http=str(server.make_url("/")),
+            )
+            async with api_session(config) as session:
+                loader = HeadLoader(config, session)
+                futures = [loader.load(id_) for id_ in range(1, 151)]
+                assert loader.load(1) is futures[0]
+                return await asyncio.gather(*futures)
+
+    heads = loop.run_until_complete(load())
+    assert heads[0] == ("main", "%040d" % 1)
+    assert heads[-1] is None
+    assert len(gitlab.requests) == 2
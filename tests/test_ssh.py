@@ -0,0 +1,50 @@
+"""Test the functionality of the ssh module."""
+import os
+import shlex
+
+from gitlab_sync.ssh import Multiplexer, ssh_command, uses_ssh
+
+
+def test_uses_ssh():
+    """Only scp-like and ssh:// URLs are taken to use ssh."""
+    assert uses_ssh("git@gitlab.example.com")
+    assert uses_ssh("ssh://git@gitlab.example.com:2222")
+    assert not uses_ssh("https://gitlab.example.com")
+
+
+def test_ssh_command(tmp_path, monkeypatch):
+    """The ssh command is looked up in the same order git looks it up."""
+    config = tmp_path / "gitconfig"
+    monkeypatch.setenv("GIT_CONFIG_GLOBAL", str(config))
+    monkeypatch.delenv("GIT_SSH_COMMAND", raising=False)
+    monkeypatch.delenv("GIT_SSH", raising=False)
+    assert ssh_command(str(tmp_path)) == "ssh"
+    monkeypatch.setenv("GIT_SSH", "/opt/my ssh")
+    assert ssh_command(str(tmp_path)) == "'/opt/my ssh'"
+    config.write_text("[core]\n\tsshCommand = ssh -i config-key\n")
+    assert ssh_command(str(tmp_path)) == "ssh -i config-key"
+    monkeypatch.setenv("GIT_SSH_COMMAND", "ssh -i key")
+    assert ssh_command(str(tmp_path)) == "ssh -i key"
+
+    # other programs are left alone
+    monkeypatch.setenv("GIT_SSH_COMMAND", "plink -batch")
+    with Multiplexer(1) as multiplexer:
+        assert multiplexer.environment() is None
+
+
+def test_multiplexer(monkeypatch):
+    """Commands share masters in a private directory removed afterwards."""
+    monkeypatch.setenv("GIT_SSH_COMMAND", "ssh -i key")
+    with Multiplexer(2) as multiplexer:
+        directory = multiplexer.directory
+        assert os.stat(directory).st_mode & 0o777 == 0o700
+        paths = []
+        for _ in range(3):
+            command = shlex.split(multiplexer.environment()["GIT_SSH_COMMAND"])
+            assert command[:3] == ["ssh", "-i", "key"]
+            assert "ControlMaster=auto" in command
+            paths.extend(arg for arg in command if arg.startswith("ControlPath="))
+        assert paths == [
+            "ControlPath=" + os.path.join(directory, "%C-" + slot) for slot in "010"
+        ]
+    assert not os.path.exists(directory)
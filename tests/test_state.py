@@ -0,0 +1,95 @@
+"""Test the functionality of the state module."""
+import shutil
+import subprocess
+from pathlib import Path
+
+import gitlab_sync
+import gitlab_sync.repository
+import gitlab_sync.state
+
+
+def make_repo(base_path, relative_path, project_id):
+    path = base_path / relative_path
+    subprocess.run(["git", "init", "-q", str(path)], check=True)
+    subprocess.run(
+        ["git", "-C", str(path), "config", "gitlab-sync.project-id", str(project_id)],
+        check=True,
+    )
+    subprocess.run(
+        ["git", "-C", str(path), "config", "gitlab-sync.gitlab-path", relative_path],
+        check=True,
+    )
+
+
+def test_enumerate_local_uses_index(tmp_path, monkeypatch):
+    """Repositories are added to the index, then read from it."""
+    make_repo(tmp_path, "group/one", 1)
+    make_repo(tmp_path, "group/two", 2)
+
+    with gitlab_sync.state.StateIndex(tmp_path) as index:
+        found = list(gitlab_sync.repository.enumerate_local(tmp_path, index))
+        assert {repo.gitlab_project_id for repo in found} == {1, 2}
+        assert set(index.entries()) == {Path("group/one"), Path("group/two")}
+
+    # details now come from the index rather than git config
+    def git(*args, **kwargs):
+        raise AssertionError("git should not be run")
+
+    monkeypatch.setattr(gitlab_sync.repository.LocalRepository, "git", git)
+    with gitlab_sync.state.StateIndex(tmp_path) as index:
+        found = {
+            repo.relative_path: repo
+            for repo in gitlab_sync.repository.enumerate_local(tmp_path, index)
+        }
+        assert found[Path("group/two")].gitlab_project_id == 2
+        assert found[Path("group/two")].gitlab_path == Path("group/two")
+
+
+def test_index_prunes_missing_repositories(tmp_path):
+    """Entries for repositories which no longer exist are removed."""
+    make_repo(tmp_path, "one", 1)
+    make_repo(tmp_path, "gone", 2)
+    with gitlab_sync.state.StateIndex(tmp_path) as index:
+        list(gitlab_sync.repository.enumerate_local(tmp_path, index))
+        shutil.rmtree(str(tmp_path / "gone"))
+        list(gitlab_sync.repository.enumerate_local(tmp_path, index))
+        assert set(index.entries()) == {Path("one")}
+
+
+def test_index_rebuilt_when_corrupt(tmp_path):
+    """A corrupt index is replaced by an empty one."""
+    state = tmp_path / gitlab_sync.state.STATE_DIRECTORY
+    state.mkdir()
+    (state / "state.sqlite").write_bytes(b"not a database")
+    with gitlab_sync.state.StateIndex(tmp_path) as index:
+        assert index.entries() == {}
+
+
+def test_enumerate_local_reads_config(tmp_path, monkeypatch):
+    """Git config is parsed in process, only running git when it can't be."""
+    make_repo(tmp_path, "group/one", 1)
+    make_repo(tmp_path, "group/sub/two", 2)
+    make_repo(tmp_path, "odd", 3)
+    with (tmp_path / "odd" / ".git" / "config").open("a") as file_:
+        file_.write('[gitlab-sync]\n\tgitlab-path = "odd;path"\n')
+    (tmp_path / "group" / "one" / "nested").mkdir()
+    make_repo(tmp_path / gitlab_sync.state.STATE_DIRECTORY, "x", 4)
+
+    run = []
+    git = gitlab_sync.repository.LocalRepository.git
+
+    def counting_git(self, *args, **kwargs):
+        run.append(self.relative_path)
+        return git(self, *args, **kwargs)
+
+    monkeypatch.setattr(gitlab_sync.repository.LocalRepository, "git", counting_git)
+    found = {
+        str(repo.relative_path): (repo.gitlab_project_id, str(repo.gitlab_path))
+        for repo in gitlab_sync.repository.enumerate_local(tmp_path)
+    }
+    assert found == {
+        "group/one": (1, "group/one"),
+        "group/sub/two": (2, "group/sub/two"),
+        "odd": (3, "odd;path"),
+    }
+    assert set(run) == {Path("odd")}
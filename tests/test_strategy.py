@@ -0,0 +1,181 @@
+"""Test the functionality of the strategy module."""
+import asyncio
+from pathlib import Path
+
+import gitlab_sync.operations
+import gitlab_sync.repository
+import gitlab_sync.strategy
+from gitlab_sync.config import RunConfig
+from gitlab_sync.repository import GitlabRepository, LocalRepository
+from gitlab_sync.state import IndexEntry
+
+
+def test_unchanged():
+    """Projects are only unchanged if fetched long enough after last activity."""
+    activity = "2020-01-01T00:00:00.000Z"
+    timestamp = gitlab_sync.repository.parse_time(activity)
+    remote = GitlabRepository(Path("group/project"), 1, activity)
+
+    entry = IndexEntry(Path("group/project"), 1, last_activity_at=activity)
+    assert not gitlab_sync.strategy._unchanged(entry, remote)
+    assert not gitlab_sync.strategy._unchanged(None, remote)
+
+    entry.fetched_at = timestamp + 60
+    assert not gitlab_sync.strategy._unchanged(entry, remote)
+
+    entry.fetched_at = timestamp + 2 * 60 * 60
+    assert gitlab_sync.strategy._unchanged(entry, remote)
+
+    remote.last_activity_at = "2020-01-02T00:00:00Z"
+    assert not gitlab_sync.strategy._unchanged(entry, remote)
+
+
+def test_checks_refs():
+    """Refs are only compared for copies fetched with the same trimming."""
+    config = RunConfig(
+        base_path=Path("/copy"),
+        paths=[Path("group")],
+        access_token="token",
+        strategy=gitlab_sync.strategy.mirror,
+        gitlab_http="https://gitlab.example.com/",
+    )
+    entry = IndexEntry(Path("group/project"), 1)
+    assert not gitlab_sync.strategy._checks_refs(config, None)
+    assert not gitlab_sync.strategy._checks_refs(config, entry)
+
+    entry.fetched_at = 100
+    assert gitlab_sync.strategy._checks_refs(config, entry)
+
+    entry.trimming = '{"depth": 1}'
+    assert not gitlab_sync.strategy._checks_refs(config, entry)
+
+    entry.trimming = None
+    config.ref_check = "none"
+    assert not gitlab_sync.strategy._checks_refs(config, entry)
+
+
+def test_parse_time():
+    """GitLab times with and without fractions and offsets are parsed."""
+    assert gitlab_sync.repository.parse_time("2020-01-01T00:00:00Z") == 1577836800
+    assert gitlab_sync.repository.parse_time("2020-01-01T01:00:00.5+01:00") == (
+        1577836800.5
+    )
+
+
+def test_maintenance_plan(tmp_path):
+    """Repositories most in need of maintenance come first, then repacks."""
+    config = RunConfig(
+        base_path=tmp_path,
+        paths=[Path("group")],
+        access_token="token",
+        strategy=gitlab_sync.strategy.mirror,
+        gitlab_http="https://gitlab.example.com/",
+    )
+    day = 24 * 60 * 60
+    packs = {"quiet": 1, "packed": 20, "fetched": 1, "old": 3, "many": 40}
+    entries = {}
+    for name, count in packs.items():
+        pack_path = tmp_path / "group" / name / ".git" / "objects" / "pack"
+        pack_path.mkdir(parents=True)
+        for number in range(count):
+            (pack_path / ("pack-%d.pack" % number)).touch()
+        entries[Path("group", name)] = IndexEntry(
+            Path("group", name), 1, cloned_at=100 * day, fetched_at=101 * day
+        )
+    for entry in entries.values():
+        entry.maintained_at = 102 * day
+    entries[Path("group/fetched")].fetched_at = 103 * day
+    entries[Path("group/old")].cloned_at = 50 * day
+
+    plan = gitlab_sync.strategy._maintenance_plan(config, entries, 104 * day)
+    assert [(task.__name__, repo.relative_path.name) for task, repo in plan] == [
+        ("maintain", "many"),
+        ("maintain", "packed"),
+        ("maintain", "fetched"),
+        ("repack", "old"),
+    ]
+
+    # pooled repositories are repacked even with one pack, then their pool
+    config.object_pool = tmp_path / "pool"
+    pool = config.object_pool / "gitlab.example.com" / "1.git"
+    for number in range(2):
+        (pool / "objects" / "pack").mkdir(parents=True, exist_ok=True)
+        (pool / "objects" / "pack" / ("pack-%d.pack" % number)).touch()
+    info = tmp_path / "group" / "quiet" / ".git" / "objects" / "info"
+    info.mkdir()
+    (info / "alternates").write_text(str(pool / "objects") + "\n")
+    entries[Path("group/quiet")].cloned_at = 60 * day
+    plan = gitlab_sync.strategy._maintenance_plan(config, entries, 104 * day)
+    assert [(task.__name__, repo.relative_path.name) for task, repo in plan][-3:] == [
+        ("repack", "old"),
+        ("repack", "quiet"),
+        ("maintain_pool", "1.git"),
+    ]
+
+
+def test_estimate():
+    """The last transfer time is used over the size of the repository."""
+    remote = GitlabRepository(Path("group/project"), 1, repository_size=50 << 20)
+    entry = IndexEntry(Path("group/project"), 1)
+    assert gitlab_sync.strategy._estimate(entry, remote) == 5
+    entry.transfer_seconds = 2.5
+    assert gitlab_sync.strategy._estimate(entry, remote) == 2.5
+    remote.repository_size = None
+    assert gitlab_sync.strategy._estimate(None, remote) == 0
+
+
+def test_scheduler(loop):
+    """The longest jobs start first, with few enough per namespace."""
+    started = []
+
+    def job(name):
+        async def run():
+            started.append(name)
+            await asyncio.sleep(0.01)
+
+        return run
+
+    async def schedule():
+        scheduler = gitlab_sync.strategy._Scheduler(2, namespace_workers=1)
+        for name, cost, namespace in [
+            ("small", 1, "a"),
+            ("large", 9, "a"),
+            ("medium", 5, "a"),
+            ("other", 0, "b"),
+            ("unknown", 0, "c"),
+        ]:
+            repo = LocalRepository(Path("/copy"), Path(namespace, name))
+            scheduler.start("copied", repo, job(name), cost, namespace)
+        await asyncio.wait([task for _, _, task in scheduler.jobs])
+
+    loop.run_until_complete(schedule())
+    # the first job starts as it is queued, as a worker is free
+    assert started[:3] == ["small", "other", "large"]
+    assert set(started[3:5]) == {"unknown", "medium"}
+
+
+def test_scheduler_sessions(loop):
+    """Schedulers sharing sessions don't run more jobs than there are together."""
+    running = []
+    most = []
+
+    async def job():
+        running.append(None)
+        most.append(len(running))
+        await asyncio.sleep(0.01)
+        running.pop()
+
+    async def schedule():
+        sessions = asyncio.Semaphore(2)
+        schedulers = [gitlab_sync.strategy._Scheduler(2, 0, sessions) for _ in "ab"]
+        for scheduler in schedulers:
+            for name in "xyz":
+                repo = LocalRepository(Path("/copy"), Path(name))
+                scheduler.start("updated", repo, job)
+        await asyncio.wait(
+            [task for scheduler in schedulers for _, _, task in scheduler.jobs]
+        )
+
+    loop.run_until_complete(schedule())
+    assert len(most) == 6
+    assert max(most) == 2